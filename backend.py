@@ -0,0 +1,519 @@
+"""可选的后台服务进程：负责对话存储和模型请求，界面通过本地 socket 连接
+
+启动后台服务:
+    python backend.py --port 8765
+
+让界面使用后台服务:
+    CHATOLLAMA_BACKEND=127.0.0.1:8765 python main.py
+
+协议为逐行 JSON。每个请求带有 id，响应使用相同的 id；同一连接上可以同时进行多个请求。
+chat 请求会持续返回 {"id", "chunk"}，结束时返回 {"id", "done", "stats"}。
+所有模型请求（包括同时启动的代理）都经过同一个 proxy.ProxyEngine，共用并发限制。
+每个对话在后台有一个修订号，upsert 可以带上客户端所见的修订号，与后台不一致时拒绝写入，
+多个窗口共用后台服务时不会互相覆盖。
+"""
+import argparse
+import copy
+import itertools
+import json
+import os
+import queue
+import socket
+import socketserver
+import sys
+import threading
+
+import proxy
+from chat_core import CONVERSATIONS_FILE, Conversation, ConversationStore
+
+DEFAULT_PORT = 8765
+FLUSH_INTERVAL = 1.0  # 后台写盘间隔（秒）
+CALL_TIMEOUT = 30  # 普通请求等待响应的最长时间（秒）
+
+class BackendError(Exception):
+    """后台服务返回的错误"""
+
+class BackendState:
+    """后台进程持有的对话数据，修改后由写盘线程批量保存"""
+    def __init__(self, store):
+        self.store = store
+        self.lock = threading.Lock()
+        conversations = store.load()
+        self.dirty = store.archive_stale(conversations) > 0
+        self.conversations = {conv.id: conv for conv in conversations}
+        self.revisions = {}  # 对话 id -> 修订号，每次写入加一，未写入过的为 0
+        self._stop_event = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop, name="BackendFlush", daemon=True)
+        self._flusher.start()
+
+    def index(self):
+        """所有对话及其修订号，已归档的只包含 id 和标题"""
+        with self.lock:
+            return {
+                'conversations': [self.conversations[conv_id].to_dict()
+                                  for conv_id in sorted(self.conversations, reverse=True)],
+                'revisions': dict(self.revisions),
+            }
+
+    def upsert(self, conversations, revisions=None):
+        """写入对话，返回新的修订号和被拒绝的对话 id
+
+        revisions 为 {对话 id: 客户端所见的修订号}，与当前修订号不一致说明对话已被其他客户端修改，
+        该对话不会写入；不在 revisions 中的对话直接写入。
+        """
+        revisions = revisions or {}
+        accepted = {}
+        conflicts = []
+        with self.lock:
+            for conv_data in conversations:
+                conv = Conversation.from_dict(conv_data)
+                current = self.revisions.get(conv.id, 0)
+                if conv.id in revisions and revisions[conv.id] != current:
+                    conflicts.append(conv.id)
+                    continue
+                self.conversations[conv.id] = conv
+                self.revisions[conv.id] = accepted[conv.id] = current + 1
+            self.dirty = True
+        return {'revisions': accepted, 'conflicts': conflicts}
+
+    def delete(self, conversation_ids):
+        with self.lock:
+            for conv_id in conversation_ids:
+                self.conversations.pop(conv_id, None)
+                self.revisions.pop(conv_id, None)
+            self.dirty = True
+
+    def archived_messages(self, conversation_id):
+        """读取对话的消息，已归档的对话保持归档状态"""
+        with self.lock:
+            conv = self.conversations[conversation_id]
+        return self.store.archived_messages(conv)
+
+    def restore(self, conversation_id):
+        """解压已归档的对话，返回其消息"""
+        with self.lock:
+            conv = self.conversations[conversation_id]
+        if conv.is_archived:
+            self.store.restore(conv)
+            with self.lock:
+                self.dirty = True
+        return conv.messages
+
+    def flush(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            conversations = [self.conversations[conv_id]
+                             for conv_id in sorted(self.conversations, reverse=True)]
+            self.dirty = False
+        try:
+            self.store.save(conversations)
+        except Exception as e:
+            print(f"保存对话历史失败: {e}")
+            with self.lock:
+                self.dirty = True
+
+    def close(self):
+        self._stop_event.set()
+        self._flusher.join()
+        self.flush()
+
+    def _flush_loop(self):
+        while not self._stop_event.wait(FLUSH_INTERVAL):
+            self.flush()
+
+class BackendHandler(socketserver.StreamRequestHandler):
+    """处理一个客户端连接"""
+    def handle(self):
+        self.write_lock = threading.Lock()
+        self.cancelled = set()
+        self.in_flight = set()  # 正在生成的 chat 请求 id
+        try:
+            self.read_requests()
+        finally:
+            # 客户端断开后停止它的所有生成，不再继续占用模型
+            self.cancelled.update(self.in_flight)
+
+    def read_requests(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                self.send({'id': None, 'error': f"无效的请求: {e}"})
+                continue
+            op = request.get('op')
+            if op == 'chat':
+                self.in_flight.add(request['id'])
+                threading.Thread(target=self.run_chat, args=(request,), daemon=True).start()
+            elif op == 'cancel':
+                self.cancelled.add(request['target'])
+            else:
+                self.run_call(op, request)
+
+    def run_call(self, op, request):
+        state = self.server.state
+        try:
+            if op == 'ping':
+                result = 'pong'
+            elif op == 'load':
+                result = state.index()
+            elif op == 'upsert':
+                result = state.upsert(request['conversations'], request.get('revisions'))
+            elif op == 'delete':
+                result = state.delete(request['conversation_ids'])
+            elif op == 'restore':
+                result = state.restore(request['conversation_id'])
+            elif op == 'archived_messages':
+                result = state.archived_messages(request['conversation_id'])
+            else:
+                raise BackendError(f"未知操作: {op}")
+            self.send({'id': request.get('id'), 'result': result})
+        except Exception as e:
+            self.send({'id': request.get('id'), 'error': str(e)})
+
+    def run_chat(self, request):
+        request_id = request['id']
+        stats = {}
+        # 界面的对话内容各不相同，不使用缓存，也不需要记录（界面自己保存）
+        chunks = self.server.engine.generate(request['model'], request['messages'], stats,
+                                             use_cache=False, record=False)
+        try:
+            for text in chunks:
+                if request_id in self.cancelled:
+                    break
+                self.send({'id': request_id, 'chunk': text})
+            self.send({'id': request_id, 'done': True, 'stats': stats})
+        except Exception as e:
+            self.send({'id': request_id, 'error': str(e)})
+        finally:
+            # 立即结束生成并释放并发名额
+            chunks.close()
+            self.in_flight.discard(request_id)
+            self.cancelled.discard(request_id)
+
+    def send(self, message):
+        data = (json.dumps(message, ensure_ascii=False) + '\n').encode('utf-8')
+        with self.write_lock:
+            try:
+                self.wfile.write(data)
+                self.wfile.flush()
+            except OSError:
+                pass  # 客户端已断开
+
+class BackendServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, state, engine=None):
+        super().__init__(address, BackendHandler)
+        self.state = state
+        self.engine = engine or proxy.ProxyEngine()
+
+class BackendClient:
+    """后台服务客户端，可以被多个线程同时使用"""
+    def __init__(self, address, timeout=5):
+        self.sock = socket.create_connection(address, timeout=timeout)
+        self.sock.settimeout(None)
+        self.rfile = self.sock.makefile('r', encoding='utf-8')
+        self._ids = itertools.count(1)
+        self._pending = {}  # 请求 id -> 响应队列
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self.closed = False  # 连接断开后为 True，之后的请求立即失败
+        self._reader = threading.Thread(target=self._read_loop, name="BackendClient", daemon=True)
+        self._reader.start()
+
+    def call(self, op, timeout=CALL_TIMEOUT, **params):
+        """发送请求并等待结果，连接断开或超时时抛出 BackendError"""
+        request_id, responses = self._send(op, params)
+        try:
+            response = responses.get(timeout=timeout)
+        except queue.Empty:
+            raise BackendError(f"后台服务响应超时: {op}")
+        finally:
+            self._pending.pop(request_id, None)
+        if 'error' in response:
+            raise BackendError(response['error'])
+        return response.get('result')
+
+    def stream_chat(self, model, messages, stats=None):
+        """与 chat_core.stream_chat 相同，但请求由后台服务执行"""
+        request_id, responses = self._send('chat', {'model': model, 'messages': messages})
+        done = False
+        try:
+            while True:
+                response = responses.get()
+                if 'error' in response:
+                    done = True
+                    raise BackendError(response['error'])
+                if response.get('done'):
+                    done = True
+                    if stats is not None:
+                        stats.update(response.get('stats') or {})
+                    return
+                yield response['chunk']
+        finally:
+            self._pending.pop(request_id, None)
+            if not done:
+                # 调用方提前停止读取，通知后台停止生成
+                try:
+                    self._write({'op': 'cancel', 'target': request_id})
+                except OSError:
+                    pass
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def _send(self, op, params):
+        request_id = next(self._ids)
+        responses = queue.Queue()
+        # 与 _read_loop 结束时的处理共用锁，连接断开后注册的请求不会无人响应
+        with self._lock:
+            if self.closed:
+                raise BackendError("与后台服务的连接已断开")
+            self._pending[request_id] = responses
+        try:
+            self._write(dict(params, op=op, id=request_id))
+        except OSError as e:
+            self._pending.pop(request_id, None)
+            raise BackendError(f"发送请求失败: {e}")
+        return request_id, responses
+
+    def _write(self, message):
+        data = (json.dumps(message, ensure_ascii=False) + '\n').encode('utf-8')
+        with self._write_lock:
+            self.sock.sendall(data)
+
+    def _read_loop(self):
+        try:
+            for line in self.rfile:
+                response = json.loads(line)
+                responses = self._pending.get(response.get('id'))
+                if responses is not None:
+                    responses.put(response)
+        except (OSError, ValueError):
+            pass
+        # 连接断开，让所有等待中的请求失败，之后的请求由 _send 直接拒绝
+        with self._lock:
+            self.closed = True
+            pending = list(self._pending.values())
+        for responses in pending:
+            responses.put({'error': "与后台服务的连接已断开"})
+
+class RemoteConversationStore:
+    """通过后台服务读写对话，接口与 ConversationStore 相同
+
+    save 只发送自上次保存以来有变化的对话，界面频繁保存时不会传输整个历史。
+    发送由写入线程完成，save 不等待后台响应，流式输出时逐块保存也不会阻塞界面；
+    上一次发送还没完成时，同一个对话的多次修改合并为一次发送。
+    写入时带上读取时的修订号，对话已被其他客户端修改时后台会拒绝，本窗口之后不再写入该对话。
+    与后台服务的连接断开后改用本地的 ConversationStore，界面可以继续使用。
+    """
+    def __init__(self, client, local=None):
+        self.client = client
+        self.local = local or ConversationStore()
+        self._fingerprints = {}
+        self._revisions = {}  # 对话 id -> 最近一次读取或写入时的修订号
+        self._conflicts = set()  # 被其他客户端修改过、不再写入的对话
+        self._condition = threading.Condition()  # 保护以上状态和待发送的修改
+        self._upserts = {}  # 等待发送的对话 id -> 对话数据
+        self._deletes = set()  # 等待发送的删除
+        self._sending = False
+        self._writer = threading.Thread(target=self._write_loop, name="RemoteConversationStore", daemon=True)
+        self._writer.start()
+
+    def load(self):
+        index = self.client.call('load')
+        conversations = [Conversation.from_dict(conv_data) for conv_data in index['conversations']]
+        with self._condition:
+            self._revisions = dict(index['revisions'])
+            self._fingerprints = {conv.id: self._fingerprint(conv) for conv in conversations}
+        return conversations
+
+    def save(self, conversations):
+        conversations = list(conversations)
+        if self.client.closed:
+            self.local.save(conversations)
+            return
+        fingerprints = {}
+        with self._condition:
+            for conv in conversations:
+                fingerprint = self._fingerprint(conv)
+                fingerprints[conv.id] = fingerprint
+                if self._fingerprints.get(conv.id) != fingerprint and conv.id not in self._conflicts:
+                    # 复制一份再交给写入线程，发送时界面可能正在修改这个对话
+                    self._upserts[conv.id] = copy.deepcopy(conv.to_dict())
+                    self._deletes.discard(conv.id)
+            for conv_id in self._fingerprints:
+                if conv_id not in fingerprints:
+                    self._deletes.add(conv_id)
+                    self._upserts.pop(conv_id, None)
+            self._fingerprints = fingerprints
+            self._condition.notify_all()
+
+    def flush(self, timeout=CALL_TIMEOUT):
+        """等待已保存的修改发送完毕，返回是否全部发送（退出前调用）"""
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: self.client.closed or not (self._upserts or self._deletes or self._sending), timeout
+            )
+
+    def _write_loop(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._upserts or self._deletes)
+                upserts, self._upserts = self._upserts, {}
+                deletes, self._deletes = self._deletes, set()
+                revisions = {conv_id: self._revisions.get(conv_id, 0) for conv_id in upserts}
+                self._sending = True
+            try:
+                self._send(upserts, revisions, deletes)
+            except BackendError as e:
+                with self._condition:
+                    # 没有发送成功的修改在下一次保存时重新发送；连接已断开时下一次保存会整体写入本地存储
+                    for conv_id in upserts:
+                        self._fingerprints.pop(conv_id, None)
+                    for conv_id in deletes:
+                        self._fingerprints.setdefault(conv_id, None)
+                if self.client.closed:
+                    print("与后台服务的连接已断开，之后改用本地存储")
+                    return
+                print(f"保存对话历史失败: {e}")
+            finally:
+                with self._condition:
+                    self._sending = False
+                    self._condition.notify_all()
+
+    def _send(self, upserts, revisions, deletes):
+        if upserts:
+            result = self.client.call('upsert', conversations=list(upserts.values()), revisions=revisions)
+            with self._condition:
+                self._revisions.update(result['revisions'])
+                conflicts = [conv_id for conv_id in result['conflicts'] if conv_id not in self._conflicts]
+                self._conflicts.update(conflicts)
+            for conv_id in conflicts:
+                print(f"对话 {conv_id} 已在其他窗口中修改，本窗口对它的修改不会保存")
+        if deletes:
+            self.client.call('delete', conversation_ids=list(deletes))
+            with self._condition:
+                for conv_id in deletes:
+                    self._revisions.pop(conv_id, None)
+
+    def add(self, conversations):
+        if self.client.closed:
+            self.local.add(conversations)
+            return
+        self.client.call('upsert', conversations=[conv.to_dict() for conv in conversations])
+
+    def archive_stale(self, conversations):
+        # 归档由后台服务在启动时完成
+        return 0
+
+    def archived_messages(self, conversation):
+        if not conversation.is_archived:
+            return conversation.messages
+        if self.client.closed:
+            return self.local.archived_messages(conversation)
+        return self.client.call('archived_messages', conversation_id=conversation.id)
+
+    def restore(self, conversation):
+        if not conversation.is_archived:
+            return conversation
+        if self.client.closed:
+            return self.local.restore(conversation)
+        conversation.messages = self.client.call('restore', conversation_id=conversation.id)
+        conversation.segment = None
+        return conversation
+
+    @staticmethod
+    def _fingerprint(conv):
+        last = conv.messages[-1]['content'] if conv.messages else ''
+        return (conv.title, conv.revision, conv.segment, len(conv.messages), hash(last))
+
+def parse_address(value):
+    host, _, port = value.rpartition(':')
+    return (host or '127.0.0.1', int(port))
+
+def connect(address):
+    """连接 host:port 处的后台服务，失败时抛出 OSError、ValueError 或 BackendError"""
+    client = BackendClient(parse_address(address))
+    client.call('ping')
+    return client
+
+def connect_from_env():
+    """根据环境变量 CHATOLLAMA_BACKEND（host:port）连接后台服务，未设置或连接失败时返回 None"""
+    address = os.environ.get('CHATOLLAMA_BACKEND')
+    if not address:
+        return None
+    try:
+        return connect(address)
+    except (OSError, ValueError, BackendError) as e:
+        print(f"连接后台服务失败，使用本地模式: {e}")
+        return None
+
+def open_conversation_store():
+    """命令行工具（批量模式、代理）写入对话历史时使用的存储
+
+    设置了 CHATOLLAMA_BACKEND 时对话历史由后台服务管理，直接写入文件会被后台服务下一次写盘覆盖，
+    因此通过后台服务写入；连接失败时抛出 BackendError，不会退回到写本地文件。
+    """
+    address = os.environ.get('CHATOLLAMA_BACKEND')
+    if not address:
+        return ConversationStore()
+    try:
+        return RemoteConversationStore(connect(address))
+    except (OSError, ValueError, BackendError) as e:
+        raise BackendError(
+            f"无法连接 CHATOLLAMA_BACKEND 指定的后台服务 {address}: {e}\n"
+            f"对话历史由后台服务管理，直接写入 {CONVERSATIONS_FILE} 会被它覆盖，因此不会写入本地文件。"
+            f"请先启动后台服务，或取消设置 CHATOLLAMA_BACKEND"
+        )
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ChatOllama 后台服务")
+    parser.add_argument('--host', default='127.0.0.1', help="监听地址（默认 127.0.0.1）")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f"监听端口（默认 {DEFAULT_PORT}）")
+    parser.add_argument('--proxy-port', type=int, help="同时启动 Ollama / OpenAI 兼容的本地代理")
+    parser.add_argument('--record-proxy', action='store_true', help="把代理请求记录到对话历史")
+    proxy.add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    state = BackendState(ConversationStore())
+    # 代理与后台服务共用对话存储，记录的对话会出现在所有客户端中
+    recorder = None
+    if args.proxy_port and args.record_proxy:
+        recorder = proxy.conversation_recorder(
+            lambda conversations: state.upsert([conv.to_dict() for conv in conversations])
+        )
+    # 界面和代理的请求共用同一个引擎，并发限制对所有请求生效
+    engine = proxy.ProxyEngine(max_concurrency=args.max_concurrency, per_model=args.per_model,
+                               cache_size=args.cache_size, recorder=recorder)
+    server = BackendServer((args.host, args.port), state, engine)
+    print(f"后台服务已启动: {args.host}:{args.port}", file=sys.stderr)
+
+    proxy_server = None
+    if args.proxy_port:
+        proxy_server = proxy.ProxyServer((args.host, args.proxy_port), engine)
+        threading.Thread(target=proxy_server.serve_forever, name="Proxy", daemon=True).start()
+        print(f"代理已启动: http://{args.host}:{args.proxy_port}", file=sys.stderr)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if proxy_server is not None:
+            proxy_server.shutdown()
+            proxy_server.server_close()
+        server.server_close()
+        state.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,236 @@
+"""无界面批量模式：从 JSONL 读取提示词，在多个模型上并发运行，结果逐行写入 JSONL
+
+用法示例:
+    python batch.py prompts.jsonl -m llama3.2 -m qwen2.5 -c 4 -o results.jsonl
+    python batch.py prompts.jsonl -m llama3.2 -m qwen2.5 -c 2 -c llama3.2=8   # 按模型指定并发数
+
+输入文件每行一个 JSON 对象，支持以下字段:
+    prompt    提示词文本（与 messages 二选一）
+    messages  完整的对话历史，格式同 Ollama chat 接口
+    id        可选，提示词编号，默认使用行号
+    models    可选，只在这些模型上运行该提示词
+"""
+import argparse
+import json
+import math
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+from backend import BackendError, open_conversation_store
+from chat_core import Conversation, ModelManager, stream_chat
+from image_store import ImageStore
+
+def load_prompts(path):
+    """读取 JSONL 提示词文件，跳过空行"""
+    prompts = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            if 'messages' not in item:
+                if 'prompt' not in item:
+                    raise ValueError(f"第 {line_no} 行缺少 prompt 或 messages 字段")
+                item['messages'] = [{'role': 'user', 'content': item['prompt']}]
+            elif not isinstance(item['messages'], list) or not item['messages']:
+                raise ValueError(f"第 {line_no} 行的 messages 必须是非空列表")
+            item.setdefault('id', str(line_no))
+            prompts.append(item)
+    return prompts
+
+def percentile(values, p):
+    """最近秩法计算百分位数，values 需已排序"""
+    if not values:
+        return 0.0
+    rank = max(1, math.ceil(p / 100 * len(values)))
+    return values[min(rank, len(values)) - 1]
+
+def run_prompt(model, item):
+    """在指定模型上运行一条提示词，返回结果记录"""
+    result = {
+        'prompt_id': item['id'],
+        'model': model,
+        'messages': item['messages'],
+        'response': '',
+        'error': None,
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'ttft': None,
+        'latency': None,
+        'chunks': 0,
+        'eval_count': None,
+        'eval_duration': None,
+    }
+    start = time.perf_counter()
+    response_text = ""
+    stats = {}
+    try:
+        for text in stream_chat(model, item['messages'], stats):
+            if result['ttft'] is None and text:
+                result['ttft'] = time.perf_counter() - start
+            response_text += text
+            result['chunks'] += 1
+    except Exception as e:
+        result['error'] = str(e)
+    result['latency'] = time.perf_counter() - start
+    result['response'] = response_text
+    result['eval_count'] = stats.get('eval_count')
+    result['eval_duration'] = stats.get('eval_duration')
+    return result
+
+def to_conversation(result, index, image_store=None):
+    """把一条结果转换成可导入对话历史的 Conversation
+
+    对话历史中的图片以 ImageStore 的哈希保存，消息里 base64 编码的图片通过 image_store 转换。
+    """
+    conv_id = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_batch{index:05d}"
+    first_prompt = result['messages'][-1]['content']
+    title = f"[{result['model']}] {first_prompt[:20]}" + ('...' if len(first_prompt) > 20 else '')
+    conv = Conversation(conv_id, title)
+    messages = result['messages']
+    if image_store is not None:
+        messages = image_store.import_messages(messages)
+    conv.messages = list(messages) + [{'role': 'assistant', 'content': result['response']}]
+    return conv
+
+def print_report(results, wall_time, out=sys.stderr):
+    """输出吞吐量与延迟百分位统计"""
+    by_model = {}
+    for result in results:
+        by_model.setdefault(result['model'], []).append(result)
+
+    print(f"总请求数: {len(results)}  总耗时: {wall_time:.2f}s  "
+          f"吞吐量: {len(results) / wall_time if wall_time else 0:.2f} 请求/秒", file=out)
+    for model, model_results in by_model.items():
+        ok = [r for r in model_results if not r['error']]
+        latencies = sorted(r['latency'] for r in ok)
+        ttfts = sorted(r['ttft'] for r in ok if r['ttft'] is not None)
+        chunks = sum(r['chunks'] for r in ok)
+        busy = sum(latencies)
+        timed = [r for r in ok if r['eval_count'] and r['eval_duration']]
+        print(f"\n模型 {model}: 成功 {len(ok)} / 失败 {len(model_results) - len(ok)}", file=out)
+        print(f"  延迟   p50={percentile(latencies, 50):.2f}s  p90={percentile(latencies, 90):.2f}s  "
+              f"p99={percentile(latencies, 99):.2f}s", file=out)
+        print(f"  首字   p50={percentile(ttfts, 50):.2f}s  p90={percentile(ttfts, 90):.2f}s  "
+              f"p99={percentile(ttfts, 99):.2f}s", file=out)
+        if timed:
+            # eval_duration 单位为纳秒，只统计生成阶段，不含排队和加载模型的时间
+            tokens = sum(r['eval_count'] for r in timed)
+            eval_seconds = sum(r['eval_duration'] for r in timed) / 1e9
+            print(f"  生成速度: {tokens / eval_seconds:.1f} tokens/秒（{tokens} tokens）", file=out)
+        else:
+            # 没有 Ollama 统计信息时按文本块估算
+            print(f"  生成速度: {chunks / busy if busy else 0:.1f} 块/秒", file=out)
+
+def parse_concurrency(values):
+    """解析 -c 参数，返回 (默认并发数, {模型: 并发数})
+
+    每个值可以是整数（默认并发数）或 模型=整数（只对该模型生效）。
+    """
+    default = 1
+    per_model = {}
+    for value in values or ():
+        model, sep, number = value.rpartition('=')
+        try:
+            concurrency = int(number)
+        except ValueError:
+            raise ValueError(f"无效的并发数: {value}")
+        if concurrency < 1:
+            raise ValueError(f"并发数必须大于 0: {value}")
+        if sep:
+            per_model[model] = concurrency
+        else:
+            default = concurrency
+    return default, per_model
+
+def run_batch(prompts, models, concurrency, output):
+    """并发运行所有 (模型, 提示词) 组合，每个模型使用独立的线程池
+
+    concurrency 为整数时所有模型相同，也可以是 parse_concurrency 返回的 (默认值, {模型: 并发数})。
+    """
+    if isinstance(concurrency, int):
+        concurrency = (concurrency, {})
+    default_concurrency, model_concurrency = concurrency
+    write_lock = threading.Lock()
+    results = []
+    executors = {model: ThreadPoolExecutor(max_workers=model_concurrency.get(model, default_concurrency))
+                 for model in models}
+    start = time.perf_counter()
+    try:
+        futures = []
+        for item in prompts:
+            for model in item.get('models') or models:
+                if model not in executors:
+                    executors[model] = ThreadPoolExecutor(
+                        max_workers=model_concurrency.get(model, default_concurrency))
+                futures.append(executors[model].submit(run_prompt, model, item))
+
+        for done, future in enumerate(as_completed(futures), 1):
+            result = future.result()
+            results.append(result)
+            # 结果完成一条写一条，中途中断也不会丢失已完成的部分
+            with write_lock:
+                output.write(json.dumps(result, ensure_ascii=False) + '\n')
+                output.flush()
+            status = "失败" if result['error'] else f"{result['latency']:.2f}s"
+            print(f"[{done}/{len(futures)}] {result['model']} #{result['prompt_id']} {status}", file=sys.stderr)
+    finally:
+        for executor in executors.values():
+            executor.shutdown(wait=True, cancel_futures=True)
+    return results, time.perf_counter() - start
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="批量运行提示词并统计各模型的吞吐量和延迟")
+    parser.add_argument('prompts', help="提示词 JSONL 文件")
+    parser.add_argument('-m', '--model', action='append', dest='models',
+                        help="要运行的模型，可重复指定；默认使用本地第一个模型")
+    parser.add_argument('-c', '--concurrency', action='append',
+                        help="每个模型的并发请求数（默认 1），可重复指定；"
+                             "写成 模型=数量 时只对该模型生效，例如 -c 2 -c llama3.2=4")
+    parser.add_argument('-o', '--output', default='-',
+                        help="结果 JSONL 文件，默认输出到标准输出")
+    parser.add_argument('--import-conversations', action='store_true',
+                        help="把成功的结果导入对话历史；设置了 CHATOLLAMA_BACKEND 时通过后台服务写入，"
+                             "否则直接写文件，请在聊天窗口未运行时使用")
+    args = parser.parse_args(argv)
+
+    try:
+        concurrency = parse_concurrency(args.concurrency)
+    except ValueError as e:
+        parser.error(str(e))
+    # 运行之前确认能写入对话历史，不能写入时不必白白运行
+    store = None
+    if args.import_conversations:
+        try:
+            store = open_conversation_store()
+        except BackendError as e:
+            parser.error(str(e))
+    models = args.models or ModelManager.get_local_models()[:1]
+    prompts = load_prompts(args.prompts)
+
+    output = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+    try:
+        results, wall_time = run_batch(prompts, models, concurrency, output)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    print_report(results, wall_time)
+
+    if args.import_conversations:
+        image_store = ImageStore()
+        try:
+            conversations = [to_conversation(result, i, image_store)
+                             for i, result in enumerate(results) if not result['error']]
+        finally:
+            image_store.shutdown()
+        store.add(conversations)
+        print(f"\n已导入 {len(conversations)} 条对话", file=sys.stderr)
+
+    return 0 if all(not r['error'] for r in results) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
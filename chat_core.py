@@ -0,0 +1,347 @@
+import gzip
+import json
+import os
+import subprocess
+from datetime import datetime, timedelta
+from typing import Iterator, List
+
+import ollama
+
+from endpoints import get_router, model_name, normalize_model
+
+DEFAULT_MODEL = "llama3.2-vision:11b"
+CONVERSATIONS_FILE = 'conversations.json'
+
+class ModelManager:
+    """模型管理类"""
+    @staticmethod
+    def get_local_models() -> List[str]:
+        """获取本地已安装的模型列表"""
+        router = get_router()
+        if router is not None:
+            # 配置了多个服务器时，返回所有可用服务器上的模型，使用后台健康检查的结果
+            router.wait_checked()
+            return router.models() or [DEFAULT_MODEL]
+        try:
+            # 执行 ollama list 命令
+            result = subprocess.run(['ollama', 'list'], capture_output=True, text=True)
+            if result.returncode == 0:
+                # 解析输出
+                lines = result.stdout.strip().split('\n')[1:]  # 跳过标题行
+                models = []
+                for line in lines:
+                    if line.strip():
+                        # 分割行并获取模型名称（第一列）
+                        model_name = line.split()[0]
+                        models.append(model_name)
+                return models if models else [DEFAULT_MODEL]  # 如果没有找到模型，返回默认模型
+            return [DEFAULT_MODEL]
+        except Exception as e:
+            print(f"获取模型列表失败: {e}")
+            return [DEFAULT_MODEL]
+
+TIME_FORMAT = "%Y%m%d_%H%M%S"
+COLD_DIR = 'conversations_cold'
+SEGMENT_SIZE = 500  # 每个压缩分段最多保存的对话数
+
+class Conversation:
+    def __init__(self, id=None, title=None):
+        self.id = id or datetime.now().strftime(TIME_FORMAT)
+        self.title = title or "新对话"
+        self.messages = []
+        self.updated_at = datetime.now().strftime(TIME_FORMAT)
+        self.segment = None  # 已归档时为所在压缩分段文件，消息需要通过 ConversationStore.restore 读取
+        self.revision = 0  # 每次 touch 加一，不保存，用于判断对话是否有修改
+
+    @property
+    def is_archived(self):
+        return self.segment is not None
+
+    def touch(self):
+        """记录对话最近一次被打开或修改的时间"""
+        self.updated_at = datetime.now().strftime(TIME_FORMAT)
+        self.revision += 1
+
+    def to_dict(self):
+        data = {
+            'id': self.id,
+            'title': self.title,
+            'updated_at': self.updated_at,
+        }
+        if self.segment:
+            data['segment'] = self.segment
+        else:
+            data['messages'] = self.messages
+        return data
+
+    # 分支：messages 只保存当前选中的路径。某个位置有多个候选时，当前路径上该位置的消息
+    # 带有 siblings（其余候选各自的后续消息列表）和 sibling_index（当前候选的序号），
+    # 各分支共享该位置之前的消息，不会复制历史。
+
+    def sibling_info(self, position):
+        """返回 position 处当前分支的序号和分支总数"""
+        head = self.messages[position]
+        return head.get('sibling_index', 0), len(head.get('siblings', ())) + 1
+
+    def branch_heads(self, position):
+        """按序号返回 position 处每个分支的第一条消息"""
+        return [suffix[0] for suffix in self._branches(position)]
+
+    def add_branch(self, position, suffix):
+        """在 position 处添加新分支（新的后续消息列表），返回新分支的序号，当前分支不变"""
+        if position >= len(self.messages):
+            self.messages.extend(suffix)
+            return 0
+        branches = self._branches(position)
+        branches.append(list(suffix))
+        self._set_branches(position, branches, self.sibling_info(position)[0])
+        return len(branches) - 1
+
+    def switch_branch(self, position, index):
+        """切换 position 处的分支，序号超出范围时循环"""
+        branches = self._branches(position)
+        self._set_branches(position, branches, index % len(branches))
+
+    def _branches(self, position):
+        head = self.messages[position]
+        branches = list(head.get('siblings', ()))
+        branches.insert(head.get('sibling_index', 0), self.messages[position:])
+        return branches
+
+    def _set_branches(self, position, branches, active):
+        for suffix in branches:
+            suffix[0].pop('siblings', None)
+            suffix[0].pop('sibling_index', None)
+        chosen = branches[active]
+        others = branches[:active] + branches[active + 1:]
+        if others:
+            chosen[0]['siblings'] = others
+            chosen[0]['sibling_index'] = active
+        self.messages[position:] = chosen
+
+    @staticmethod
+    def from_dict(data):
+        conv = Conversation(data['id'], data['title'])
+        conv.messages = data.get('messages', [])
+        # 旧版本没有 updated_at，使用 id 中的创建时间
+        conv.updated_at = data.get('updated_at') or data['id'][:15]
+        conv.segment = data.get('segment')
+        return conv
+
+class ConversationStore:
+    """对话历史的持久化，GUI 和命令行工具共用同一个文件
+
+    长时间未使用的对话会被移到 COLD_DIR 下的 gzip 压缩分段中，
+    conversations.json 里只保留它们的 id、标题和所在分段，打开时再解压读取。
+    """
+    def __init__(self, path=CONVERSATIONS_FILE, archive_after_days=None):
+        self.path = path
+        self.cold_dir = os.path.join(os.path.dirname(os.path.abspath(path)), COLD_DIR)
+        if archive_after_days is None:
+            archive_after_days = float(os.environ.get('CHATOLLAMA_ARCHIVE_DAYS', 30))
+        self.archive_after_days = archive_after_days
+        self._segment_cache = (None, {})  # 最近一次解压的分段 (文件名, {id: 对话数据})
+        self._segments = set()  # 读取索引时被引用的分段以及本实例新建的分段，只有这些分段可能被删除
+
+    def load(self) -> List[Conversation]:
+        """读取全部对话，文件不存在时返回空列表"""
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        conversations = [Conversation.from_dict(conv_data) for conv_data in data]
+        self._segments.update(conv.segment for conv in conversations if conv.is_archived)
+        return conversations
+
+    def save(self, conversations):
+        """按给定顺序写入全部对话（先写临时文件再替换，避免写一半被读到）
+
+        索引写入后，删除本实例已知、但不再被任何对话引用的压缩分段。
+        """
+        conversations = list(conversations)
+        data = [conv.to_dict() for conv in conversations]
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, self.path)
+        self._remove_unused_segments(conversations)
+
+    def add(self, conversations):
+        """把对话合并进已有历史，id 相同的会被覆盖"""
+        merged = {conv.id: conv for conv in self.load()}
+        for conv in conversations:
+            merged[conv.id] = conv
+        self.save(sorted(merged.values(), key=lambda x: x.id, reverse=True))
+
+    def archive_stale(self, conversations):
+        """把超过期限未使用的对话写入压缩分段，返回归档的数量
+
+        调用方需要随后调用 save 写回索引。archive_after_days 为 0 时不归档。
+        """
+        if not self.archive_after_days:
+            return 0
+        cutoff = (datetime.now() - timedelta(days=self.archive_after_days)).strftime(TIME_FORMAT)
+        stale = [conv for conv in conversations if not conv.is_archived and conv.updated_at < cutoff]
+        if not stale:
+            return 0
+
+        os.makedirs(self.cold_dir, exist_ok=True)
+        stamp = datetime.now().strftime(TIME_FORMAT)
+        for start in range(0, len(stale), SEGMENT_SIZE):
+            batch = stale[start:start + SEGMENT_SIZE]
+            segment = f"{stamp}_{start // SEGMENT_SIZE:04d}.json.gz"
+            tmp_path = os.path.join(self.cold_dir, segment + '.tmp')
+            with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+                json.dump([conv.to_dict() for conv in batch], f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(tmp_path, os.path.join(self.cold_dir, segment))
+            self._segments.add(segment)
+            for conv in batch:
+                conv.segment = segment
+                conv.messages = []
+        return len(stale)
+
+    def archived_messages(self, conversation):
+        """读取已归档对话的消息，不改变对话本身（供预取使用）
+
+        不加锁：最近解压的分段缓存整体替换，多个线程同时读取时最多重复解压，不会读到不完整的数据。
+        """
+        segment = conversation.segment
+        if segment is None:
+            return conversation.messages
+        cached_segment, entries = self._segment_cache
+        if cached_segment != segment:
+            with gzip.open(os.path.join(self.cold_dir, segment), 'rt', encoding='utf-8') as f:
+                entries = {conv_data['id']: conv_data for conv_data in json.load(f)}
+            self._segment_cache = (segment, entries)
+        return entries[conversation.id]['messages']
+
+    def restore(self, conversation):
+        """从压缩分段中读取已归档对话的消息，使其重新成为普通对话
+
+        只读取数据，不更新 updated_at，打开对话时由调用方调用 touch。
+        """
+        if not conversation.is_archived:
+            return conversation
+        # 先填充消息再清除分段标记，保存时不会写出空的对话
+        conversation.messages = self.archived_messages(conversation)
+        conversation.segment = None
+        return conversation
+
+    def _remove_unused_segments(self, conversations):
+        """删除其中的对话都已恢复或删除的分段文件
+
+        只处理本实例读取索引时见过或自己创建的分段，索引缺失或由其他进程写入的分段不会被误删。
+        """
+        used = {conv.segment for conv in conversations if conv.is_archived}
+        for name in self._segments - used:
+            try:
+                os.remove(os.path.join(self.cold_dir, name))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"删除归档分段失败: {e}")
+                continue
+            self._segments.discard(name)
+
+def stream_chat(model, messages, stats=None, **params) -> Iterator[str]:
+    """向 Ollama 发起流式对话请求，逐块返回新生成的文本
+
+    如果传入 stats 字典，结束时会写入 Ollama 返回的统计信息（eval_count、eval_duration 等）。
+    params 为其他请求参数（options、format、keep_alive），原样传给 Ollama。
+    """
+    router = get_router()
+    if router is not None:
+        # 配置了多个服务器时，由路由选择负载最低的服务器
+        stream = router.chat(model, messages, **params)
+    else:
+        stream = ollama.chat(
+            model=model,
+            messages=messages,
+            stream=True,
+            **params
+        )
+    for chunk in stream:
+        if stats is not None and chunk.get('done'):
+            for key in ('eval_count', 'eval_duration', 'prompt_eval_count', 'load_duration'):
+                if chunk.get(key) is not None:
+                    stats[key] = chunk[key]
+        yield chunk['message']['content']
+
+def get_model_sizes():
+    """获取本地模型占用的大小（字节），用于估算加载后所需的内存"""
+    try:
+        # 大小未知的模型不放进结果，分批时会单独成批
+        return {model_name(info): info['size'] for info in ollama.list()['models'] if info.get('size')}
+    except Exception as e:
+        print(f"获取模型大小失败: {e}")
+        return {}
+
+def get_loaded_models():
+    """获取 Ollama 当前已加载到内存中的模型"""
+    try:
+        return {model_name(info) for info in ollama.ps()['models']}
+    except Exception as e:
+        print(f"获取已加载模型失败: {e}")
+        return set()
+
+def get_memory_budget():
+    """可用于加载模型的内存（字节）
+
+    优先读取环境变量 CHATOLLAMA_MEMORY_GB，否则取本机物理内存的 75%，无法获取时返回 None。
+    """
+    budget_gb = os.environ.get('CHATOLLAMA_MEMORY_GB')
+    if budget_gb:
+        return int(float(budget_gb) * 1024 ** 3)
+    try:
+        return int(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') * 0.75)
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def plan_model_waves(models, sizes, budget, loaded=()):
+    """把同一服务器上的模型分成若干批
+
+    同一批内的模型可以同时放进内存，并行运行；批与批之间顺序执行，避免模型反复加载卸载。
+    已经加载的模型排在最前面，其余按大小从大到小依次放进第一个装得下的批次。
+    大小未知的模型单独成批；内存预算未知时所有模型逐个运行。
+    """
+    if not budget:
+        return [[model] for model in models]
+    ordered = sorted(models, key=lambda m: (m not in loaded, -sizes.get(m, budget)))
+    waves = []
+    used = []
+    for model in ordered:
+        size = sizes.get(model, budget)
+        for i, wave in enumerate(waves):
+            if used[i] + size <= budget:
+                wave.append(model)
+                used[i] += size
+                break
+        else:
+            waves.append([model])
+            used.append(size)
+    return waves
+
+def plan_compare_waves(models):
+    """为多模型对比分批
+
+    没有配置服务器池时按本机的模型大小和内存分批；配置了服务器池时，每个池按其服务器上的
+    模型大小、已加载模型和内存预算单独分批，不同池的同一批次合并在一起同时运行。
+    """
+    router = get_router()
+    if router is None:
+        return plan_model_waves(models, get_model_sizes(), get_memory_budget(), get_loaded_models())
+    by_pool = {}
+    for model in models:
+        by_pool.setdefault(router.pool_for(model), []).append(model)
+    waves = []
+    for pool, pool_models in by_pool.items():
+        pool_sizes, pool_loaded = pool.model_state()
+        sizes = {model: pool_sizes[normalize_model(model)] for model in pool_models
+                 if normalize_model(model) in pool_sizes}
+        loaded = {model for model in pool_models if normalize_model(model) in pool_loaded}
+        budget = pool.memory_budget or get_memory_budget()
+        for i, wave in enumerate(plan_model_waves(pool_models, sizes, budget, loaded)):
+            if i == len(waves):
+                waves.append([])
+            waves[i].extend(wave)
+    return waves
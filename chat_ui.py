@@ -1,64 +1,110 @@
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
                             QHBoxLayout, QTextEdit, QLineEdit, QPushButton, 
-                            QComboBox, QLabel, QScrollArea, QListWidget, 
-                            QListWidgetItem, QSplitter, QMenu, QTextBrowser, QSizePolicy, QFrame)
-from PyQt6.QtCore import Qt, pyqtSignal, QThread, QSize, QRegularExpression, QWaitCondition, QMutex
+                            QComboBox, QLabel, QScrollArea, QListView, QAbstractItemView,
+                            QListWidget, QListWidgetItem, QFileDialog, QSpinBox,
+                            QSplitter, QMenu, QTextBrowser, QSizePolicy, QFrame)
+from PyQt6.QtCore import (Qt, pyqtSignal, QThread, QSize, QRegularExpression, QWaitCondition, QMutex,
+                          QAbstractListModel, QModelIndex, QObject)
 from PyQt6.QtGui import QFont, QPalette, QColor, QIcon, QTextCharFormat, QSyntaxHighlighter, QTextOption
 import sys
-import ollama
-import json
-import os
-from datetime import datetime
+import threading
+import time
+from collections import OrderedDict, deque
+from bisect import bisect_left
 from markdown import markdown
-import subprocess
-from typing import List
-
-class ModelManager:
-    """模型管理类"""
-    @staticmethod
-    def get_local_models() -> List[str]:
-        """获取本地已安装的模型列表"""
-        try:
-            # 执行 ollama list 命令
-            result = subprocess.run(['ollama', 'list'], capture_output=True, text=True)
-            if result.returncode == 0:
-                # 解析输出
-                lines = result.stdout.strip().split('\n')[1:]  # 跳过标题行
-                models = []
-                for line in lines:
-                    if line.strip():
-                        # 分割行并获取模型名称（第一列）
-                        model_name = line.split()[0]
-                        models.append(model_name)
-                return models if models else ["llama3.2-vision:11b"]  # 如果没有找到模型，返回默认模型
-            return ["llama3.2-vision:11b"]
-        except Exception as e:
-            print(f"获取模型列表失败: {e}")
-            return ["llama3.2-vision:11b"]
+from chat_core import (ModelManager, Conversation, ConversationStore, stream_chat,
+                       plan_compare_waves)
+from image_store import ImageStore, image_size_for_model
+from stall_monitor import format_stall
+from backend import connect_from_env, RemoteConversationStore
 
-class Conversation:
-    def __init__(self, id=None, title=None):
-        self.id = id or datetime.now().strftime("%Y%m%d_%H%M%S")
-        self.title = title or "新对话"
-        self.messages = []
+class ConversationListModel(QAbstractListModel):
+    """侧边栏对话列表模型
 
-    def to_dict(self):
-        return {
-            'id': self.id,
-            'title': self.title,
-            'messages': self.messages
-        }
+    按 id（时间戳）倒序显示。内部只保存一个升序排列的 id 列表和 id -> 标题的字典，
+    行号与 id 之间可以通过二分查找互相换算，插入、删除、重命名都不需要扫描整个列表。
+    """
+    IdRole = Qt.ItemDataRole.UserRole
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._ids = []  # 升序排列，第 row 行对应 self._ids[-1 - row]
+        self._titles = {}
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._ids)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        conv_id = self.conversation_id(index.row())
+        if role == Qt.ItemDataRole.DisplayRole:
+            return self._titles[conv_id]
+        if role == Qt.ItemDataRole.ToolTipRole:
+            return self._titles[conv_id]
+        if role == self.IdRole:
+            return conv_id
+        return None
+
+    def conversation_id(self, row):
+        """根据行号获取对话 id"""
+        return self._ids[len(self._ids) - 1 - row]
+
+    def row_of(self, conv_id):
+        """根据对话 id 获取行号，不存在时返回 -1"""
+        pos = bisect_left(self._ids, conv_id)
+        if pos < len(self._ids) and self._ids[pos] == conv_id:
+            return len(self._ids) - 1 - pos
+        return -1
 
-    @staticmethod
-    def from_dict(data):
-        conv = Conversation(data['id'], data['title'])
-        conv.messages = data['messages']
-        return conv
+    def ids(self):
+        """按显示顺序（最新的在前）遍历对话 id"""
+        return reversed(self._ids)
+
+    def reset(self, items):
+        """批量设置对话，items 为 (id, title) 序列"""
+        self.beginResetModel()
+        self._titles = dict(items)
+        self._ids = sorted(self._titles)
+        self.endResetModel()
+
+    def insert(self, conv_id, title):
+        """按顺序插入对话，返回所在行号"""
+        if conv_id in self._titles:
+            self.set_title(conv_id, title)
+            return self.row_of(conv_id)
+        pos = bisect_left(self._ids, conv_id)
+        row = len(self._ids) - pos
+        self.beginInsertRows(QModelIndex(), row, row)
+        self._ids.insert(pos, conv_id)
+        self._titles[conv_id] = title
+        self.endInsertRows()
+        return row
+
+    def remove(self, conv_id):
+        """删除对话"""
+        row = self.row_of(conv_id)
+        if row < 0:
+            return
+        self.beginRemoveRows(QModelIndex(), row, row)
+        del self._ids[len(self._ids) - 1 - row]
+        del self._titles[conv_id]
+        self.endRemoveRows()
+
+    def set_title(self, conv_id, title):
+        """更新对话标题，只刷新对应的一行"""
+        row = self.row_of(conv_id)
+        if row < 0:
+            return
+        self._titles[conv_id] = title
+        index = self.index(row)
+        self.dataChanged.emit(index, index, [Qt.ItemDataRole.DisplayRole, Qt.ItemDataRole.ToolTipRole])
 
 class ConversationList(QWidget):
     conversation_selected = pyqtSignal(Conversation)
+    conversation_hovered = pyqtSignal(Conversation)  # 鼠标悬停或键盘焦点移动到对话上
     
-    def __init__(self):
+    def __init__(self, store=None):
         super().__init__()
         layout = QVBoxLayout(self)
         
@@ -79,114 +125,184 @@ class ConversationList(QWidget):
         """)
         layout.addWidget(self.new_chat_btn)
         
-        # 对话列表
-        self.list_widget = QListWidget()
-        self.list_widget.setContextMenuPolicy(Qt.ContextMenuPolicy.CustomContextMenu)
-        self.list_widget.customContextMenuRequested.connect(self.show_context_menu)
-        self.list_widget.setStyleSheet("""
-            QListWidget {
+        # 对话列表（模型/视图，只有可见的行才会被绘制）
+        self.model = ConversationListModel(self)
+        self.list_view = QListView()
+        self.list_view.setModel(self.model)
+        self.list_view.setUniformItemSizes(True)  # 行高一致，滚动时无需逐行测量
+        self.list_view.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        self.list_view.setContextMenuPolicy(Qt.ContextMenuPolicy.CustomContextMenu)
+        self.list_view.customContextMenuRequested.connect(self.show_context_menu)
+        self.list_view.clicked.connect(self.on_index_clicked)
+        self.list_view.setMouseTracking(True)  # 需要开启才会发出 entered 信号
+        self.list_view.entered.connect(self.on_index_hovered)
+        self.list_view.selectionModel().currentChanged.connect(self.on_current_changed)
+        self.list_view.setStyleSheet("""
+            QListView {
                 background-color: transparent;
                 border: none;
             }
-            QListWidget::item {
+            QListView::item {
                 background-color: #2d2d2d;
                 color: white;
                 border-radius: 5px;
                 padding: 8px;
                 margin: 2px 0px;
             }
-            QListWidget::item:selected {
+            QListView::item:selected {
                 background-color: #3d3d3d;
             }
-            QListWidget::item:hover {
+            QListView::item:hover {
                 background-color: #3d3d3d;
             }
         """)
-        layout.addWidget(self.list_widget)
+        layout.addWidget(self.list_view)
         
         self.conversations = {}
+        self.selecting = False  # 正在通过代码选中对话，此时的 currentChanged 不触发预取
+        self.store = store or ConversationStore()
         self.load_conversations()
         
     def add_conversation(self, conversation):
         """添加新对话到列表顶部"""
         self.conversations[conversation.id] = conversation
-        # 在列表顶部插入新对话
-        item = QListWidgetItem(conversation.title)
-        item.setData(Qt.ItemDataRole.UserRole, conversation.id)
-        self.list_widget.insertItem(0, item)
+        row = self.model.insert(conversation.id, conversation.title)
         # 选中新对话
-        self.list_widget.setCurrentRow(0)
+        self.list_view.setCurrentIndex(self.model.index(row))
         self.save_conversations()
         
     def load_conversations(self):
         """加载对话历史，按时间倒序排序"""
         try:
-            if os.path.exists('conversations.json'):
-                with open('conversations.json', 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    # 按照 id (时间戳) 排序，最新的在前
-                    sorted_data = sorted(data, key=lambda x: x['id'], reverse=True)
-                    for conv_data in sorted_data:
-                        conv = Conversation.from_dict(conv_data)
-                        self.conversations[conv.id] = conv
-                        item = QListWidgetItem(conv.title)
-                        item.setData(Qt.ItemDataRole.UserRole, conv.id)
-                        self.list_widget.addItem(item)
+            conversations = self.store.load()
+            # 把长时间未使用的对话移到压缩分段中，索引里只保留标题
+            if self.store.archive_stale(conversations):
+                self.store.save(sorted(conversations, key=lambda x: x.id, reverse=True))
+            for conv in conversations:
+                self.conversations[conv.id] = conv
+            # 一次性重置模型，排序由模型完成
+            self.model.reset((conv.id, conv.title) for conv in self.conversations.values())
         except Exception as e:
             print(f"加载对话历史失败: {e}")
             
     def save_conversations(self):
         """保存对话历史，保持时间顺序"""
         try:
-            # 将对话列表转换为列表并按时间戳排序
-            conversations_list = list(self.conversations.values())
-            sorted_conversations = sorted(conversations_list, key=lambda x: x.id, reverse=True)
-            data = [conv.to_dict() for conv in sorted_conversations]
-            with open('conversations.json', 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            # 模型本身已经有序，直接按显示顺序输出
+            self.store.save(self.conversations[conv_id] for conv_id in self.model.ids())
         except Exception as e:
             print(f"保存对话历史失败: {e}")
 
+    def set_title(self, conv_id, title):
+        """更新对话标题并保存"""
+        if conv_id in self.conversations:
+            self.conversations[conv_id].title = title
+            self.model.set_title(conv_id, title)
+            self.save_conversations()
+
+    def select_conversation(self, conv_id):
+        """在列表中选中对话并发出选择信号"""
+        row = self.model.row_of(conv_id)
+        if row < 0:
+            return
+        index = self.model.index(row)
+        self.selecting = True
+        try:
+            self.list_view.setCurrentIndex(index)
+        finally:
+            self.selecting = False
+        self.list_view.scrollTo(index)
+        self.conversation_selected.emit(self.conversations[conv_id])
+
+    def on_index_clicked(self, index):
+        if index.isValid():
+            self.select_conversation(index.data(ConversationListModel.IdRole))
+
+    def on_current_changed(self, index):
+        # 鼠标点击时 currentChanged 先于 clicked 发出，被选中的对话马上就会打开，不需要预取
+        if self.selecting or QApplication.mouseButtons() != Qt.MouseButton.NoButton:
+            return
+        self.on_index_hovered(index)
+
+    def on_index_hovered(self, index):
+        if index.isValid():
+            self.conversation_hovered.emit(self.conversations[index.data(ConversationListModel.IdRole)])
+
+    def recent_conversations(self, count):
+        """按显示顺序返回最近的若干个对话"""
+        recent = []
+        for conv_id in self.model.ids():
+            if len(recent) >= count:
+                break
+            recent.append(self.conversations[conv_id])
+        return recent
+
     def show_context_menu(self, position):
+        index = self.list_view.indexAt(position)
+        if not index.isValid():
+            return
         menu = QMenu()
         delete_action = menu.addAction("删除对话")
-        action = menu.exec(self.list_widget.mapToGlobal(position))
+        action = menu.exec(self.list_view.mapToGlobal(position))
         
         if action == delete_action:
-            current_item = self.list_widget.currentItem()
-            if current_item:
-                conv_id = current_item.data(Qt.ItemDataRole.UserRole)
-                self.delete_conversation(conv_id)
+            self.delete_conversation(index.data(ConversationListModel.IdRole))
 
     def delete_conversation(self, conv_id):
         """删除对话"""
-        # 从字典中删除
+        # 从字典和模型中删除
         if conv_id in self.conversations:
             del self.conversations[conv_id]
-        
-        # 从列表控件中删除当前选中的项
-        current_item = self.list_widget.currentItem()
-        if current_item:
-            self.list_widget.takeItem(self.list_widget.row(current_item))
+        self.model.remove(conv_id)
         
         # 如果删除后没有对话了，创建一个新对话
-        if self.list_widget.count() == 0:
+        if self.model.rowCount() == 0:
             self.new_chat_btn.click()
         else:
-            # 选择第一个对话并触发选择事件
-            self.list_widget.setCurrentRow(0)
-            # 发出信号通知需要加载新的对话
-            selected_item = self.list_widget.item(0)
-            if selected_item:
-                self.list_widget.itemClicked.emit(selected_item)
+            # 选择第一个对话并通知需要加载新的对话
+            self.select_conversation(self.model.conversation_id(0))
         
         # 保存更新后的对话列表
         self.save_conversations()
 
+def render_markdown(message):
+    """把 AI 回复的 Markdown 转换为带样式的 HTML"""
+    html_content = markdown(
+        message,
+        extensions=['fenced_code', 'tables', 'codehilite']
+    )
+    return f"""
+        <style>
+            pre {{
+                background-color: #1e1e1e;
+                padding: 10px;
+                border-radius: 5px;
+                overflow-x: auto;
+                font-family: 'Courier New', monospace;
+                white-space: pre-wrap;
+                word-wrap: break-word;
+            }}
+            code {{
+                background-color: #1e1e1e;
+                padding: 2px 4px;
+                border-radius: 3px;
+                font-family: 'Courier New', monospace;
+            }}
+            p {{
+                margin: 0;
+                padding: 0;
+                white-space: pre-wrap;
+                word-wrap: break-word;
+            }}
+        </style>
+        {html_content}
+    """
+
 class MessageWidget(QWidget):
     regenerate_requested = pyqtSignal()  # 添加信号
+    branch_requested = pyqtSignal(int)  # 切换到上一个 (-1) 或下一个 (1) 分支
     
-    def __init__(self, message, is_user=False):
+    def __init__(self, message, is_user=False, html=None):
         super().__init__()
         self.main_layout = QVBoxLayout()
         self.main_layout.setContentsMargins(10, 5, 10, 5)
@@ -205,7 +321,7 @@ class MessageWidget(QWidget):
         self.message_bubble.setWordWrapMode(QTextOption.WrapMode.WrapAtWordBoundaryOrAnywhere)
         
         # 设置内容
-        self.update_content(message, is_user)
+        self.update_content(message, is_user, html)
         
         # 设置大小策略
         self.message_bubble.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Minimum)
@@ -302,8 +418,32 @@ class MessageWidget(QWidget):
             """)
             regenerate_button.clicked.connect(self.regenerate_requested.emit)  # 发送信号
             
+            # 分支切换，只有多个候选回答时才显示
+            branch_style = """
+                QPushButton {
+                    background-color: transparent;
+                    color: #0078d4;
+                    border: none;
+                    font-size: 12px;
+                }
+            """
+            self.prev_branch_button = QPushButton("<")
+            self.prev_branch_button.setFixedSize(20, 25)
+            self.prev_branch_button.setStyleSheet(branch_style)
+            self.prev_branch_button.clicked.connect(lambda: self.branch_requested.emit(-1))
+            self.branch_label = QLabel()
+            self.branch_label.setStyleSheet("color: rgba(255, 255, 255, 0.6); font-size: 12px;")
+            self.next_branch_button = QPushButton(">")
+            self.next_branch_button.setFixedSize(20, 25)
+            self.next_branch_button.setStyleSheet(branch_style)
+            self.next_branch_button.clicked.connect(lambda: self.branch_requested.emit(1))
+            self.set_branch_info(0, 1)
+            
             button_layout.addWidget(copy_button)
             button_layout.addWidget(regenerate_button)
+            button_layout.addWidget(self.prev_branch_button)
+            button_layout.addWidget(self.branch_label)
+            button_layout.addWidget(self.next_branch_button)
             button_layout.addStretch()
             
             self.main_layout.addLayout(button_layout)
@@ -311,40 +451,10 @@ class MessageWidget(QWidget):
         self.main_layout.addLayout(self.bubble_layout)
         self.setLayout(self.main_layout)
         
-    def update_content(self, message, is_user=False):
-        """更新消息内容"""
+    def update_content(self, message, is_user=False, html=None):
+        """更新消息内容，html 为预先渲染好的内容时直接使用"""
         if not is_user:
-            html_content = markdown(
-                message,
-                extensions=['fenced_code', 'tables', 'codehilite']
-            )
-            styled_html = f"""
-                <style>
-                    pre {{
-                        background-color: #1e1e1e;
-                        padding: 10px;
-                        border-radius: 5px;
-                        overflow-x: auto;
-                        font-family: 'Courier New', monospace;
-                        white-space: pre-wrap;
-                        word-wrap: break-word;
-                    }}
-                    code {{
-                        background-color: #1e1e1e;
-                        padding: 2px 4px;
-                        border-radius: 3px;
-                        font-family: 'Courier New', monospace;
-                    }}
-                    p {{
-                        margin: 0;
-                        padding: 0;
-                        white-space: pre-wrap;
-                        word-wrap: break-word;
-                    }}
-                </style>
-                {html_content}
-            """
-            self.message_bubble.setHtml(styled_html)
+            self.message_bubble.setHtml(html if html is not None else render_markdown(message))
         else:
             self.message_bubble.setText(message)
         
@@ -360,6 +470,12 @@ class MessageWidget(QWidget):
         self.message_bubble.setFixedWidth(int(content_width))
         self.message_bubble.setFixedHeight(int(content_height))
     
+    def set_branch_info(self, index, count):
+        """显示当前是第几个候选回答"""
+        self.branch_label.setText(f"{index + 1}/{count}")
+        for widget in (self.prev_branch_button, self.branch_label, self.next_branch_button):
+            widget.setVisible(count > 1)
+    
     def copy_text(self):
         """复制文本到剪贴板"""
         clipboard = QApplication.clipboard()
@@ -368,20 +484,26 @@ class MessageWidget(QWidget):
 class ChatThread(QThread):
     """聊天线程类"""
     response_received = pyqtSignal(str, str)  # 发送 (conversation_id, text)
+    response_finished = pyqtSignal(str)  # 一次回复结束（包括出错和被停止），在所有 response_received 之后发出
     
-    def __init__(self, model, conversation_id):
+    def __init__(self, model, conversation_id, image_store=None, chat=stream_chat):
         super().__init__()
         self.model = model
         self.conversation_id = conversation_id
-        self.messages = []  # 存储对话历史
+        self.image_store = image_store
+        self.chat = chat  # 本地请求或后台服务的 stream_chat
+        self.messages = []  # 存储对话历史，图片只保存哈希
         self.is_running = True
         self.condition = QWaitCondition()
         self.mutex = QMutex()
         self.new_message = False  # 标记是否有新消息
         
-    def add_message(self, message, role='user'):
+    def add_message(self, message, role='user', images=None):
         """添加新消息到对话历史"""
-        self.messages.append({'role': role, 'content': message})
+        msg = {'role': role, 'content': message}
+        if images:
+            msg['images'] = list(images)
+        self.messages.append(msg)
         
     def run(self):
         while self.is_running:
@@ -395,18 +517,14 @@ class ChatThread(QThread):
                 break
                 
             try:
-                # 使用完整的对话历史进行请求
-                stream = ollama.chat(
-                    model=self.model,
-                    messages=self.messages,
-                    stream=True
-                )
-                
+                # 使用完整的对话历史进行请求，图片哈希在这里换成缓存的 base64 编码
+                messages = self.messages
+                if self.image_store is not None:
+                    messages = self.image_store.resolve_messages(messages)
                 response_text = ""
-                for chunk in stream:
+                for text in self.chat(self.model, messages):
                     if not self.is_running:
                         break
-                    text = chunk['message']['content']
                     response_text += text
                     self.response_received.emit(self.conversation_id, response_text)
                 
@@ -417,10 +535,17 @@ class ChatThread(QThread):
                     
             except Exception as e:
                 self.response_received.emit(self.conversation_id, f"\n错误: {str(e)}")
+            self.response_finished.emit(self.conversation_id)
+    
+    def set_history(self, messages):
+        """切换分支后重新设置对话历史"""
+        self.messages = []
+        for msg in messages:
+            self.add_message(msg['content'], msg['role'], msg.get('images'))
     
-    def send_message(self, message):
+    def send_message(self, message, images=None):
         """发送新消息"""
-        self.add_message(message, 'user')
+        self.add_message(message, 'user', images)
         self.mutex.lock()
         self.new_message = True
         self.condition.wakeOne()  # 唤醒线程处理新消息
@@ -433,7 +558,151 @@ class ChatThread(QThread):
         self.condition.wakeOne()  # 唤醒线程以便退出
         self.mutex.unlock()
 
+PREFETCH_TAIL = 20  # 预先渲染的末尾消息数
+PREFETCH_CACHE_SIZE = 8  # 最多缓存的预取对话数
+PREFETCH_RECENT = 3  # 启动时预取的最近对话数
+PREFETCH_QUEUE_SIZE = 3  # 最多排队的预取请求数，超出时丢弃最早的请求
+
+def prefetch_version(messages):
+    """对话内容的版本标识，内容变化后预取结果失效"""
+    return (len(messages), len(messages[-1]['content']) if messages else 0)
+
+class PrefetchThread(QThread):
+    """后台预取线程：读取归档对话（不解除归档）并预先渲染末尾消息"""
+    prefetched = pyqtSignal(str, object)  # (conversation_id, (版本, [html]))
+
+    def __init__(self, store):
+        super().__init__()
+        self.store = store
+        self.requests = deque()
+        self.condition = threading.Condition()
+        self.is_running = True
+
+    def request(self, conversation):
+        """添加预取请求，队列已满时丢弃并返回最早的请求"""
+        dropped = None
+        with self.condition:
+            if len(self.requests) >= PREFETCH_QUEUE_SIZE:
+                dropped = self.requests.popleft()
+            self.requests.append(conversation)
+            self.condition.notify()
+        return dropped
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.is_running and not self.requests:
+                    self.condition.wait()
+                if not self.is_running:
+                    break
+                # 最新的请求最可能被点击，优先处理
+                conversation = self.requests.pop()
+            try:
+                messages = self.store.archived_messages(conversation)
+                # 用户消息直接显示纯文本，只需渲染 AI 回复
+                html = [None if msg['role'] == 'user' else render_markdown(msg['content'])
+                        for msg in messages[-PREFETCH_TAIL:]]
+                self.prefetched.emit(conversation.id, (prefetch_version(messages), html))
+            except Exception as e:
+                print(f"预取对话失败: {e}")
+                self.prefetched.emit(conversation.id, None)
+
+    def stop(self):
+        with self.condition:
+            self.is_running = False
+            self.condition.notify()
+
+class ConversationPrefetcher(QObject):
+    """预取缓存：在用户点击之前准备好可能要打开的对话"""
+    def __init__(self, store, parent=None):
+        super().__init__(parent)
+        self.cache = OrderedDict()  # conversation_id -> (版本, [html])，按最近使用排序
+        self.pending = set()
+        self.thread = PrefetchThread(store)
+        self.thread.prefetched.connect(self.on_prefetched)
+        self.thread.start()
+
+    def prefetch(self, conversation):
+        """请求预取对话，已缓存或正在预取时忽略"""
+        if conversation.id in self.pending:
+            return
+        cached = self.cache.get(conversation.id)
+        # 归档的对话在解除归档之前内容不会变化
+        if cached and (conversation.is_archived or cached[0] == prefetch_version(conversation.messages)):
+            self.cache.move_to_end(conversation.id)
+            return
+        self.pending.add(conversation.id)
+        dropped = self.thread.request(conversation)
+        if dropped is not None:
+            self.pending.discard(dropped.id)
+
+    def on_prefetched(self, conv_id, payload):
+        self.pending.discard(conv_id)
+        if payload is None:
+            return
+        self.cache[conv_id] = payload
+        self.cache.move_to_end(conv_id)
+        while len(self.cache) > PREFETCH_CACHE_SIZE:
+            self.cache.popitem(last=False)
+
+    def take(self, conversation):
+        """取出对话末尾消息的预渲染结果，没有或已过期时返回 None"""
+        cached = self.cache.pop(conversation.id, None)
+        if cached and cached[0] == prefetch_version(conversation.messages):
+            return cached[1]
+        return None
+
+    def stop(self):
+        self.thread.stop()
+        self.thread.wait()
+
+class RegenerateThread(QThread):
+    """重新生成线程：基于同一段历史并发生成多个候选回答"""
+    candidate_updated = pyqtSignal(int, str)  # (候选序号, 累积文本)
+    candidate_finished = pyqtSignal(int)
+
+    def __init__(self, model, messages, count, image_store=None, chat=stream_chat):
+        super().__init__()
+        self.model = model
+        self.messages = messages
+        self.count = count
+        self.image_store = image_store
+        self.chat = chat
+        self.is_running = True
+
+    def run(self):
+        messages = self.messages
+        if self.image_store is not None:
+            messages = self.image_store.resolve_messages(messages)
+        workers = [threading.Thread(target=self.run_candidate, args=(i, messages), daemon=True)
+                   for i in range(self.count)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    def run_candidate(self, index, messages):
+        """在工作线程中生成一个候选回答"""
+        response_text = ""
+        try:
+            for text in self.chat(self.model, messages):
+                if not self.is_running:
+                    break
+                response_text += text
+                self.candidate_updated.emit(index, response_text)
+        except Exception as e:
+            self.candidate_updated.emit(index, f"{response_text}\n错误: {str(e)}")
+        self.candidate_finished.emit(index)
+
+    def stop(self):
+        """停止生成，正在进行的流会在下一块时退出"""
+        self.is_running = False
+
 class ChatDisplay(QScrollArea):
+    regenerate_requested = pyqtSignal(object)  # (MessageWidget)
+    branch_requested = pyqtSignal(object, int)  # (MessageWidget, 方向)
+    older_requested = pyqtSignal()  # 滚动到顶部且还有更早的消息未显示
+    
     def __init__(self):
         super().__init__()
         self.setWidgetResizable(True)
@@ -452,25 +721,81 @@ class ChatDisplay(QScrollArea):
         
         # 保存最后一个消息组件的引用
         self.last_message = None
+        # 第一个消息组件在对话中的位置，更早的消息滚动到顶部时再创建
+        self.offset = 0
+        # 在顶部插入消息时记录到底部的距离，布局更新后据此恢复滚动位置
+        self.scroll_anchor = None
+        self.verticalScrollBar().valueChanged.connect(self.on_scrolled)
+        self.verticalScrollBar().rangeChanged.connect(self.on_range_changed)
         
-    def clear_messages(self):
-        """清空所有消息"""
+    def clear_messages(self, offset=0):
+        """清空所有消息，之后添加的第一条消息位于对话的 offset 处"""
         while self.layout.count() > 1:
             item = self.layout.takeAt(0)
             if item.widget():
                 item.widget().deleteLater()
         self.last_message = None
+        self.offset = offset
+        self.scroll_anchor = None
+    
+    def truncate(self, count):
+        """只保留对话中的前 count 条消息"""
+        count = max(count - self.offset, 0)
+        while self.layout.count() - 1 > count:
+            item = self.layout.takeAt(count)
+            if item.widget():
+                item.widget().deleteLater()
+        self.last_message = self.layout.itemAt(count - 1).widget() if count > 0 else None
+    
+    def message_index(self, message_widget):
+        """消息组件在对话中的位置"""
+        index = self.layout.indexOf(message_widget)
+        return index + self.offset if index >= 0 else -1
+    
+    def message_widget(self, position):
+        """对话中 position 处的消息组件，尚未显示时返回 None"""
+        item = self.layout.itemAt(position - self.offset) if position >= self.offset else None
+        return item.widget() if item else None
+    
+    def create_message_widget(self, message, is_user, html=None):
+        message_widget = MessageWidget(message, is_user, html)
+        if not is_user:
+            # 连接重新生成和分支切换信号
+            message_widget.regenerate_requested.connect(
+                lambda: self.regenerate_requested.emit(message_widget)
+            )
+            message_widget.branch_requested.connect(
+                lambda delta: self.branch_requested.emit(message_widget, delta)
+            )
+        return message_widget
+    
+    def prepend_message(self, message, is_user=False, html=None):
+        """在顶部插入更早的一条消息，保持当前看到的内容不动"""
+        if self.scroll_anchor is None:
+            bar = self.verticalScrollBar()
+            self.scroll_anchor = bar.maximum() - bar.value()
+        message_widget = self.create_message_widget(message, is_user, html)
+        self.layout.insertWidget(0, message_widget)
+        self.offset -= 1
+        return message_widget
+    
+    def on_range_changed(self, minimum, maximum):
+        if self.scroll_anchor is not None:
+            self.verticalScrollBar().setValue(maximum - self.scroll_anchor)
+            self.scroll_anchor = None
+        elif maximum == 0 and self.offset > 0:
+            # 已显示的消息不足一屏，无法滚动，继续加载更早的消息
+            self.older_requested.emit()
+    
+    def on_scrolled(self, value):
+        if value == self.verticalScrollBar().minimum() and self.offset > 0 and self.scroll_anchor is None:
+            self.older_requested.emit()
                 
-    def add_message(self, message, is_user=False, new_message=True):
+    def add_message(self, message, is_user=False, new_message=True, html=None):
         """添加或更新消息"""
         if new_message:
             # 创建新消息
-            message_widget = MessageWidget(message, is_user)
-            if not is_user:
-                # 连接重新生成信号
-                message_widget.regenerate_requested.connect(
-                    lambda: self.parent().parent().regenerate_response(message_widget)
-                )
+            message_widget = self.create_message_widget(message, is_user, html)
             self.layout.insertWidget(self.layout.count() - 1, message_widget)
             self.last_message = message_widget
         elif self.last_message is not None:
@@ -480,7 +805,291 @@ class ChatDisplay(QScrollArea):
         # 滚动到底部
         self.verticalScrollBar().setValue(self.verticalScrollBar().maximum())
 
+class CompareThread(QThread):
+    """多模型对比线程：按内存情况分批调度，同一批的模型并行请求"""
+    chunk_received = pyqtSignal(str, str)  # (model, 累积文本)
+    first_token = pyqtSignal(str, float)  # (model, 首字延迟秒数)
+    model_finished = pyqtSignal(str, float, int, str)  # (model, 每秒 token 数, token 数, 错误信息)
+    wave_started = pyqtSignal(list)  # 当前批次的模型
+
+    def __init__(self, models, prompt, chat=stream_chat):
+        super().__init__()
+        self.models = models
+        self.prompt = prompt
+        self.chat = chat
+        self.is_running = True
+
+    def run(self):
+        waves = plan_compare_waves(self.models)
+        for wave in waves:
+            if not self.is_running:
+                break
+            self.wave_started.emit(wave)
+            workers = [threading.Thread(target=self.run_model, args=(model,), daemon=True) for model in wave]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+    def run_model(self, model):
+        """在工作线程中请求单个模型并发出进度信号"""
+        stats = {}
+        response_text = ""
+        chunks = 0
+        start = time.perf_counter()
+        first = None
+        try:
+            for text in self.chat(model, [{'role': 'user', 'content': self.prompt}], stats):
+                if not self.is_running:
+                    break
+                if first is None and text:
+                    first = time.perf_counter()
+                    self.first_token.emit(model, first - start)
+                response_text += text
+                chunks += 1
+                self.chunk_received.emit(model, response_text)
+        except Exception as e:
+            self.model_finished.emit(model, 0.0, 0, str(e))
+            return
+        # 优先使用 Ollama 返回的 token 统计，否则按收到的块数估算
+        tokens = stats.get('eval_count', chunks)
+        if stats.get('eval_duration'):
+            seconds = stats['eval_duration'] / 1e9
+        else:
+            seconds = time.perf_counter() - (first or start)
+        self.model_finished.emit(model, tokens / seconds if seconds > 0 else 0.0, tokens, "")
+
+    def stop(self):
+        """停止对比，正在进行的流会在下一块时退出"""
+        self.is_running = False
+
+class CompareColumn(QFrame):
+    """对比窗口中单个模型的回答列"""
+    def __init__(self, model):
+        super().__init__()
+        self.setStyleSheet("""
+            QFrame {
+                background-color: rgba(45, 45, 45, 0.8);
+                border-radius: 10px;
+            }
+        """)
+        layout = QVBoxLayout(self)
+        self.title_label = QLabel(model)
+        self.title_label.setStyleSheet("color: white; font-size: 14px; font-weight: bold;")
+        self.stats_label = QLabel("等待中...")
+        self.stats_label.setStyleSheet("color: rgba(255, 255, 255, 0.6); font-size: 12px;")
+        self.answer = QTextBrowser()
+        self.answer.setOpenExternalLinks(True)
+        self.answer.setStyleSheet("""
+            QTextBrowser {
+                background-color: transparent;
+                color: white;
+                border: none;
+            }
+        """)
+        layout.addWidget(self.title_label)
+        layout.addWidget(self.stats_label)
+        layout.addWidget(self.answer)
+        self.setMinimumWidth(280)
+        self.text = ""
+        self.ttft = None
+
+    def set_text(self, text):
+        # 流式输出时只显示纯文本，结束后再渲染 Markdown
+        self.text = text
+        self.answer.setPlainText(text)
+        self.answer.verticalScrollBar().setValue(self.answer.verticalScrollBar().maximum())
+
+    def set_first_token(self, seconds):
+        self.ttft = seconds
+        self.stats_label.setText(f"首字 {seconds:.2f}s · 生成中...")
+
+    def finish(self, tokens_per_sec, tokens, error):
+        if error:
+            self.stats_label.setText("请求失败")
+            self.answer.setPlainText(f"错误: {error}")
+            return
+        ttft = f"首字 {self.ttft:.2f}s · " if self.ttft is not None else ""
+        self.stats_label.setText(f"{ttft}{tokens_per_sec:.1f} tokens/s · {tokens} tokens")
+        self.answer.setHtml(render_markdown(self.text))
+
+class CompareWindow(QWidget):
+    """多模型对比窗口：同一个问题同时发给多个模型，并排显示回答"""
+    def __init__(self, models, prompt="", chat=stream_chat):
+        super().__init__()
+        self.chat = chat
+        self.setWindowTitle("模型对比")
+        self.resize(1200, 700)
+        self.setStyleSheet("""
+            QWidget {
+                background-color: rgba(30, 30, 30, 0.95);
+                color: white;
+            }
+            QLineEdit {
+                background-color: rgba(45, 45, 45, 0.95);
+                border: 2px solid rgba(61, 61, 61, 0.9);
+                border-radius: 20px;
+                padding: 10px 15px;
+                font-size: 14px;
+            }
+            QPushButton {
+                background-color: #0078d4;
+                border: none;
+                border-radius: 20px;
+                font-size: 14px;
+            }
+            QListWidget {
+                background-color: rgba(45, 45, 45, 0.8);
+                border: none;
+                border-radius: 8px;
+            }
+        """)
+        self.thread = None
+        self.columns = {}
+        self.generation = 0  # 每次开始对比加一
+
+        layout = QVBoxLayout(self)
+
+        # 模型选择（可多选）
+        self.model_list = QListWidget()
+        self.model_list.setMaximumHeight(120)
+        for model in models:
+            item = QListWidgetItem(model)
+            item.setFlags(item.flags() | Qt.ItemFlag.ItemIsUserCheckable)
+            item.setCheckState(Qt.CheckState.Unchecked)
+            self.model_list.addItem(item)
+        layout.addWidget(QLabel("选择要对比的模型:"))
+        layout.addWidget(self.model_list)
+
+        # 输入区域
+        input_layout = QHBoxLayout()
+        self.input_field = QLineEdit(prompt)
+        self.input_field.setPlaceholderText("输入要对比的问题...")
+        self.input_field.returnPressed.connect(self.start_compare)
+        self.send_button = QPushButton("对比")
+        self.send_button.setFixedSize(60, 40)
+        self.send_button.clicked.connect(self.start_compare)
+        input_layout.addWidget(self.input_field)
+        input_layout.addWidget(self.send_button)
+        layout.addLayout(input_layout)
+
+        self.status_label = QLabel("")
+        self.status_label.setStyleSheet("color: rgba(255, 255, 255, 0.6); font-size: 12px;")
+        layout.addWidget(self.status_label)
+
+        # 回答列
+        self.columns_area = QScrollArea()
+        self.columns_area.setWidgetResizable(True)
+        self.columns_container = QWidget()
+        self.columns_layout = QHBoxLayout(self.columns_container)
+        self.columns_area.setWidget(self.columns_container)
+        layout.addWidget(self.columns_area)
+
+    def selected_models(self):
+        return [self.model_list.item(i).text() for i in range(self.model_list.count())
+                if self.model_list.item(i).checkState() == Qt.CheckState.Checked]
+
+    def start_compare(self):
+        prompt = self.input_field.text().strip()
+        models = self.selected_models()
+        if not prompt or not models:
+            return
+        self.stop_compare()
+
+        # 重新创建回答列
+        while self.columns_layout.count():
+            item = self.columns_layout.takeAt(0)
+            if item.widget():
+                item.widget().deleteLater()
+        self.columns = {}
+        for model in models:
+            column = CompareColumn(model)
+            self.columns[model] = column
+            self.columns_layout.addWidget(column)
+
+        # 停止的旧线程可能还有排队中的信号，用批次号区分，旧批次的信号直接忽略
+        self.generation += 1
+        generation = self.generation
+        thread = CompareThread(models, prompt, self.chat)
+        thread.chunk_received.connect(
+            lambda model, text: self.update_column(generation, model, 'set_text', text)
+        )
+        thread.first_token.connect(
+            lambda model, seconds: self.update_column(generation, model, 'set_first_token', seconds)
+        )
+        thread.model_finished.connect(
+            lambda model, tps, tokens, error: self.update_column(generation, model, 'finish', tps, tokens, error)
+        )
+        thread.wave_started.connect(lambda wave: self.on_wave_started(generation, wave))
+        thread.finished.connect(lambda: self.on_compare_finished(generation, thread))
+        self.thread = thread
+        self.thread.start()
+
+    def update_column(self, generation, model, method, *args):
+        column = self.columns.get(model)
+        if generation == self.generation and column is not None:
+            getattr(column, method)(*args)
+
+    def on_wave_started(self, generation, wave):
+        if generation == self.generation:
+            self.status_label.setText(f"正在运行: {', '.join(wave)}")
+
+    def on_compare_finished(self, generation, thread):
+        if generation == self.generation:
+            self.status_label.setText("对比完成" if thread.is_running else "对比已停止")
+
+    def stop_compare(self):
+        if self.thread is not None:
+            self.thread.stop()
+            self.thread.wait()
+            self.thread = None
+
+    def closeEvent(self, event):
+        self.stop_compare()
+        event.accept()
+
+class StallDebugPanel(QWidget):
+    """调试面板：显示界面卡顿事件及采样到的调用栈"""
+    stall_detected = pyqtSignal(object)  # 由监测线程发出，在界面线程中处理
+
+    def __init__(self):
+        super().__init__()
+        self.setWindowTitle("卡顿记录")
+        self.resize(800, 500)
+        layout = QVBoxLayout(self)
+        self.log_view = QTextEdit()
+        self.log_view.setReadOnly(True)
+        self.log_view.setLineWrapMode(QTextEdit.LineWrapMode.NoWrap)
+        self.log_view.setStyleSheet("""
+            QTextEdit {
+                background-color: #1e1e1e;
+                color: white;
+                font-family: 'Courier New', monospace;
+                font-size: 12px;
+            }
+        """)
+        layout.addWidget(self.log_view)
+        self.stall_detected.connect(self.add_event)
+
+    def add_event(self, event):
+        self.log_view.append(format_stall(event))
+
+def plain_message(msg):
+    """去掉分支等本地字段，得到发送给模型的消息"""
+    plain = {'role': msg['role'], 'content': msg['content']}
+    if msg.get('images'):
+        plain['images'] = msg['images']
+    return plain
+
+def user_display_text(msg):
+    """用户消息的显示文本，附带图片时注明数量"""
+    if msg.get('images'):
+        return f"{msg['content']}\n[附图 {len(msg['images'])} 张]"
+    return msg['content']
+
 class ChatWindow(QMainWindow):
+    image_prepared = pyqtSignal(int, str, str)  # (附件批次, 图片哈希, 错误信息)，由图片处理线程池发出
+    
     def __init__(self):
         super().__init__()
         self.setWindowTitle("AI 聊天助手")
@@ -546,6 +1155,12 @@ class ChatWindow(QMainWindow):
         
         # 初始化变量
         self.chat_threads = {}
+        self.streaming = set()  # 正在接收回复或生成候选回答的对话 id，期间不能发送消息
+        self.pending_candidates = {}  # 对话 id -> 还没有生成完的候选回答数
+        
+        # 设置了 CHATOLLAMA_BACKEND 时，存储和模型请求都交给后台服务
+        self.backend = connect_from_env()
+        self.chat = self.backend_chat if self.backend else stream_chat
         self.current_conversation = None
         self.is_new_response = True
         
@@ -558,7 +1173,9 @@ class ChatWindow(QMainWindow):
         splitter = QSplitter(Qt.Orientation.Horizontal)
         
         # 创建左侧对话列表
-        self.conversation_list = ConversationList()
+        self.conversation_list = ConversationList(
+            RemoteConversationStore(self.backend) if self.backend else None
+        )
         self.conversation_list.setMinimumWidth(100)
         self.conversation_list.setMaximumWidth(150)
         splitter.addWidget(self.conversation_list)
@@ -589,14 +1206,45 @@ class ChatWindow(QMainWindow):
             }
         """)
         
+        # 重新生成时并发生成的候选回答数
+        candidates_label = QLabel("候选数:")
+        candidates_label.setStyleSheet("color: white; font-size: 14px;")
+        self.candidates_spin = QSpinBox()
+        self.candidates_spin.setRange(1, 5)
+        self.candidates_spin.setValue(2)
+        self.candidates_spin.setStyleSheet("""
+            QSpinBox {
+                background-color: rgba(45, 45, 45, 180);
+                color: white;
+                padding: 6px;
+                border: 1px solid #3d3d3d;
+                border-radius: 8px;
+                font-size: 14px;
+            }
+        """)
+        
+        # 多模型对比按钮
+        self.compare_button = QPushButton("对比")
+        self.compare_button.setFixedSize(60, 36)
+        self.compare_button.clicked.connect(self.open_compare_window)
+        self.compare_window = None
+        
         model_layout.addWidget(model_label)
         model_layout.addWidget(self.model_combo)
+        model_layout.addWidget(self.compare_button)
+        model_layout.addWidget(candidates_label)
+        model_layout.addWidget(self.candidates_spin)
         model_layout.addStretch()
         chat_layout.addLayout(model_layout)
         
         # 创建聊天显示区域
         self.chat_display = ChatDisplay()
+        self.chat_display.regenerate_requested.connect(self.regenerate_response)
+        self.chat_display.branch_requested.connect(self.switch_branch)
+        self.chat_display.older_requested.connect(self.load_older_messages)
         chat_layout.addWidget(self.chat_display)
+        self.regenerate_thread = None
+        self.render_cache = {}  # id(消息) -> (消息, 内容, html)，切换分支时复用渲染结果
         
         # 创建输入区域
         input_layout = QHBoxLayout()
@@ -627,6 +1275,28 @@ class ChatWindow(QMainWindow):
         """)
         self.send_button.clicked.connect(self.send_message)
         
+        # 图片附件（供视觉模型使用），预处理在线程池中完成
+        self.image_store = ImageStore()
+        self.pending_paths = []  # 等待随下一条消息发送的图片文件
+        self.pending_images = []  # 已按 pending_size 处理完成的图片哈希
+        self.pending_size = None
+        self.processing_images = 0
+        self.image_generation = 0  # 切换对话或模型时加一，旧批次的处理结果直接丢弃
+        self.image_prepared.connect(self.on_image_prepared)
+        self.attach_button = QPushButton("图片")
+        self.attach_button.setFixedSize(60, 40)
+        self.attach_button.setStyleSheet("""
+            QPushButton {
+                background-color: rgba(45, 45, 45, 180);
+                color: white;
+                border: 2px solid #3d3d3d;
+                border-radius: 20px;
+                font-size: 14px;
+            }
+        """)
+        self.attach_button.clicked.connect(self.attach_images)
+        
+        input_layout.addWidget(self.attach_button)
         input_layout.addWidget(self.input_field)
         input_layout.addWidget(self.send_button)
         chat_layout.addLayout(input_layout)
@@ -636,7 +1306,20 @@ class ChatWindow(QMainWindow):
         
         # 连接信号
         self.conversation_list.new_chat_btn.clicked.connect(self.new_conversation)
-        self.conversation_list.list_widget.itemClicked.connect(self.load_conversation)
+        self.conversation_list.conversation_selected.connect(self.load_conversation)
+        self.model_combo.currentTextChanged.connect(self.on_model_changed)
+        
+        # 预取鼠标悬停、键盘焦点所在以及最近的对话
+        self.prefetcher = ConversationPrefetcher(self.conversation_list.store, self)
+        self.conversation_list.conversation_hovered.connect(self.prefetch_conversation)
+        for conversation in self.conversation_list.recent_conversations(PREFETCH_RECENT):
+            self.prefetch_conversation(conversation)
+    
+    def backend_chat(self, model, messages, stats=None):
+        """通过后台服务请求模型，与后台服务的连接断开后改为本地请求"""
+        if self.backend.closed:
+            return stream_chat(model, messages, stats)
+        return self.backend.stream_chat(model, messages, stats)
     
     def focusOutEvent(self, event):
         """当窗口失去焦点时隐藏"""
@@ -645,54 +1328,126 @@ class ChatWindow(QMainWindow):
         
     def new_conversation(self):
         """创建新对话"""
+        # 还没有对话时发送消息也会先创建对话，此时保留已选择的图片
+        if self.current_conversation:
+            self.clear_pending_images()
         self.current_conversation = Conversation()
         self.conversation_list.add_conversation(self.current_conversation)
         self.chat_display.clear_messages()
+        self.update_send_button()
         
         # 为新对话创建线程
-        thread = ChatThread(self.model_combo.currentText(), self.current_conversation.id)
+        thread = ChatThread(self.model_combo.currentText(), self.current_conversation.id, self.image_store, self.chat)
         thread.response_received.connect(self.update_chat_display)
+        thread.response_finished.connect(self.on_response_finished)
         self.chat_threads[self.current_conversation.id] = thread
         thread.start()
     
-    def load_conversation(self, item):
+    def load_conversation(self, conversation):
         """加载选中的对话"""
+        # 已归档的对话先从压缩分段中解压，失败时保持当前对话不变，
+        # 否则新消息会追加到仍处于归档状态的空对话上，保存时被丢弃
+        restored = conversation.is_archived
+        if restored:
+            try:
+                self.conversation_list.store.restore(conversation)
+            except Exception as e:
+                print(f"读取归档对话失败: {e}")
+                return
+        
         # 停止当前正在运行的线程
         self.stop_current_thread()
+        self.clear_pending_images()
         
-        conv_id = item.data(Qt.ItemDataRole.UserRole)
-        self.current_conversation = self.conversation_list.conversations[conv_id]
-        self.chat_display.clear_messages()
+        # 记录打开时间，只打开过的对话也不会被归档。刚从分段恢复的对话立即保存，
+        # 索引里不再引用它所在的分段；其余对话的打开时间随下一次保存写入，单击时不重写整个索引
+        conversation.touch()
+        if restored:
+            self.conversation_list.save_conversations()
+        self.current_conversation = conversation
+        self.render_cache = {}
+        self.update_send_button()
         
-        # 显示历史消息
-        for msg in self.current_conversation.messages:
-            is_user = msg['role'] == 'user'
-            self.chat_display.add_message(
-                msg['content'],
-                is_user=is_user,
-                new_message=True
-            )
-            if not is_user:
-                # 更新最后一条 AI 消息的引用
-                self.chat_display.last_message = self.chat_display.layout.itemAt(
-                    self.chat_display.layout.count() - 2
-                ).widget()
+        # 只显示末尾的消息，优先使用预取时渲染好的内容，更早的消息滚动到顶部时再加载
+        tail_start = max(0, len(conversation.messages) - PREFETCH_TAIL)
+        self.chat_display.clear_messages(tail_start)
+        self.display_messages(tail_start, self.prefetcher.take(self.current_conversation))
         
         # 创建新的聊天线程
-        thread = ChatThread(self.model_combo.currentText(), self.current_conversation.id)
+        thread = ChatThread(self.model_combo.currentText(), self.current_conversation.id, self.image_store, self.chat)
         thread.response_received.connect(self.update_chat_display)
+        thread.response_finished.connect(self.on_response_finished)
         # 加载历史消息到线程
         for msg in self.current_conversation.messages:
-            thread.add_message(msg['content'], msg['role'])
+            thread.add_message(msg['content'], msg['role'], msg.get('images'))
         self.chat_threads[self.current_conversation.id] = thread
         thread.start()
     
+    def display_messages(self, start=0, prefetched=None):
+        """从 start 开始重新显示当前对话的消息，prefetched 为末尾消息的预渲染结果"""
+        self.chat_display.truncate(start)
+        messages = self.current_conversation.messages
+        tail_start = len(messages) - len(prefetched) if prefetched else len(messages)
+        for i in range(start, len(messages)):
+            msg = messages[i]
+            is_user = msg['role'] == 'user'
+            html = None
+            if not is_user:
+                if i >= tail_start and prefetched[i - tail_start] is not None:
+                    html = prefetched[i - tail_start]
+                    self.render_cache[id(msg)] = (msg, msg['content'], html)
+                else:
+                    html = self.rendered_html(msg)
+            self.chat_display.add_message(
+                user_display_text(msg) if is_user else msg['content'],
+                is_user=is_user,
+                new_message=True,
+                html=html
+            )
+            if not is_user:
+                self.chat_display.last_message.set_branch_info(*self.current_conversation.sibling_info(i))
+        self.is_new_response = True
+    
+    def load_older_messages(self):
+        """滚动到顶部时在上方补充显示更早的一批消息"""
+        conversation = self.current_conversation
+        end = self.chat_display.offset
+        if not conversation or end <= 0:
+            return
+        for i in range(end - 1, max(0, end - PREFETCH_TAIL) - 1, -1):
+            msg = conversation.messages[i]
+            is_user = msg['role'] == 'user'
+            message_widget = self.chat_display.prepend_message(
+                user_display_text(msg) if is_user else msg['content'],
+                is_user=is_user,
+                html=None if is_user else self.rendered_html(msg)
+            )
+            if not is_user:
+                message_widget.set_branch_info(*conversation.sibling_info(i))
+    
+    def rendered_html(self, msg):
+        """AI 回复的渲染结果，内容没有变化时直接复用"""
+        cached = self.render_cache.get(id(msg))
+        if cached and cached[0] is msg and cached[1] == msg['content']:
+            return cached[2]
+        html = render_markdown(msg['content'])
+        self.render_cache[id(msg)] = (msg, msg['content'], html)
+        return html
+    
+    def prefetch_conversation(self, conversation):
+        """后台预取对话，当前正在显示的对话不需要预取"""
+        if conversation is not self.current_conversation:
+            self.prefetcher.prefetch(conversation)
+    
     def stop_current_thread(self):
         """停止当前对话的线程"""
         if self.current_conversation and self.current_conversation.id in self.chat_threads:
             thread = self.chat_threads[self.current_conversation.id]
             thread.stop()
             thread.wait()
+            # 切换对话时候选回答仍在后台生成，对话保持忙碌状态
+            if self.current_conversation.id not in self.pending_candidates:
+                self.streaming.discard(self.current_conversation.id)
             # 确保最后一条消息被正确保存
             if thread.conversation_id == self.current_conversation.id:
                 self.is_new_response = True
@@ -703,35 +1458,124 @@ class ChatWindow(QMainWindow):
             self.new_conversation()
             
         message = self.input_field.text().strip()
-        if not message:
+        if not message or self.processing_images or self.current_conversation.id in self.streaming:
             return
             
-        # 保存用户消息
-        self.current_conversation.messages.append({
+        # 保存用户消息，图片只记录哈希
+        user_message = {
             'role': 'user',
             'content': message
-        })
+        }
+        images = self.pending_images
+        self.clear_pending_images()
+        if images:
+            user_message['images'] = images
+        self.current_conversation.messages.append(user_message)
+        self.current_conversation.touch()
         
         # 显示用户消息
-        self.chat_display.add_message(message, is_user=True)
+        self.chat_display.add_message(user_display_text(user_message), is_user=True)
         self.input_field.clear()
         
         # 更新对话标题
         if len(self.current_conversation.messages) == 1:
-            self.current_conversation.title = message[:20] + ('...' if len(message) > 20 else '')
-            self.conversation_list.save_conversations()
-            # 更新列表显示
-            for i in range(self.conversation_list.list_widget.count()):
-                item = self.conversation_list.list_widget.item(i)
-                if item.data(Qt.ItemDataRole.UserRole) == self.current_conversation.id:
-                    item.setText(self.current_conversation.title)
-                    break
+            title = message[:20] + ('...' if len(message) > 20 else '')
+            self.conversation_list.set_title(self.current_conversation.id, title)
         
-        # 使用当前对话的线程发送消息
+        # 使用当前对话的线程发送消息，模型以选择框为准，与图片的处理尺寸一致
         thread = self.chat_threads[self.current_conversation.id]
-        thread.send_message(message)
+        thread.model = self.model_combo.currentText()
+        thread.send_message(message, images)
+        self.streaming.add(self.current_conversation.id)
+        self.update_send_button()
         self.is_new_response = True
     
+    def on_response_finished(self, conversation_id):
+        """回复结束后，让对话线程的历史与保存的当前分支一致"""
+        self.streaming.discard(conversation_id)
+        self.update_send_button()
+        conversation = self.conversation_list.conversations.get(conversation_id)
+        if conversation is not None:
+            self.sync_thread_history(conversation)
+    
+    def attach_images(self):
+        """选择图片附件，交给线程池解码、缩放和编码"""
+        paths, _ = QFileDialog.getOpenFileNames(
+            self, "选择图片", "", "图片 (*.png *.jpg *.jpeg *.webp *.bmp *.gif)"
+        )
+        if not paths:
+            return
+        self.pending_paths.extend(paths)
+        model = self.model_combo.currentText()
+        if image_size_for_model(model) != self.pending_size:
+            self.prepare_pending_images(model)
+        else:
+            self.submit_images(paths, model)
+        self.update_attach_button()
+    
+    def on_model_changed(self, model):
+        """切换模型后按新模型的输入尺寸重新处理已选择的图片"""
+        if model and self.pending_paths and image_size_for_model(model) != self.pending_size:
+            self.prepare_pending_images(model)
+            self.update_attach_button()
+    
+    def prepare_pending_images(self, model):
+        """丢弃之前的处理结果，按 model 的输入尺寸处理全部已选择的图片"""
+        self.image_generation += 1
+        self.pending_images = []
+        self.processing_images = 0
+        self.pending_size = image_size_for_model(model)
+        self.submit_images(self.pending_paths, model)
+    
+    def submit_images(self, paths, model):
+        generation = self.image_generation
+        for path in paths:
+            self.processing_images += 1
+            future = self.image_store.submit(path, model)
+            future.add_done_callback(lambda future: self.emit_image_prepared(generation, future))
+    
+    def clear_pending_images(self):
+        """清空附件，正在处理的图片完成后也会被丢弃"""
+        self.image_generation += 1
+        self.pending_paths = []
+        self.pending_images = []
+        self.pending_size = None
+        self.processing_images = 0
+        self.update_attach_button()
+    
+    def emit_image_prepared(self, generation, future):
+        # 在线程池中回调，通过信号回到界面线程
+        try:
+            self.image_prepared.emit(generation, future.result(), "")
+        except Exception as e:
+            self.image_prepared.emit(generation, "", str(e))
+    
+    def on_image_prepared(self, generation, key, error):
+        """图片处理完成"""
+        if generation != self.image_generation:
+            return
+        self.processing_images -= 1
+        if error:
+            print(f"处理图片失败: {error}")
+        elif key not in self.pending_images:
+            self.pending_images.append(key)
+        self.update_attach_button()
+    
+    def update_attach_button(self):
+        """在按钮上显示附件状态，图片处理期间暂停发送"""
+        if self.processing_images:
+            self.attach_button.setText("处理中")
+        elif self.pending_images:
+            self.attach_button.setText(f"图片 {len(self.pending_images)}")
+        else:
+            self.attach_button.setText("图片")
+        self.update_send_button()
+    
+    def update_send_button(self):
+        """图片处理期间以及当前对话正在生成回答时暂停发送"""
+        busy = self.current_conversation is not None and self.current_conversation.id in self.streaming
+        self.send_button.setEnabled(self.processing_images == 0 and not busy)
+    
     def update_chat_display(self, conversation_id, text):
         """更新聊天显示"""
         # 只有当消息属于当前对话时才更新显示
@@ -763,6 +1607,15 @@ class ChatWindow(QMainWindow):
         for thread in self.chat_threads.values():
             thread.stop()
             thread.wait()
+        if self.regenerate_thread is not None:
+            self.regenerate_thread.stop()
+            self.regenerate_thread.wait()
+        self.prefetcher.stop()
+        self.image_store.shutdown()
+        if self.backend:
+            # 等待还没发送的对话写入后台服务再断开
+            self.conversation_list.store.flush()
+            self.backend.close()
         event.accept()
         
     def resizeEvent(self, event):
@@ -780,36 +1633,99 @@ class ChatWindow(QMainWindow):
                         text_browser.document().adjustSize()
         
     def regenerate_response(self, message_widget):
-        """重新生成回答"""
-        if self.current_conversation and self.current_conversation.messages:
-            # 获取最后一个用户消息
-            user_messages = [msg for msg in self.current_conversation.messages if msg['role'] == 'user']
-            if user_messages:
-                last_user_message = user_messages[-1]['content']
-                
-                # 清空当前消息组件的内容
-                message_widget.update_content("")
-                
-                # 创建新的聊天线程
-                thread = ChatThread(
-                    self.model_combo.currentText(),
-                    self.current_conversation.id
-                )
-                thread.response_received.connect(lambda conv_id, text: self.update_regenerated_response(message_widget, conv_id, text))
-                self.chat_threads[self.current_conversation.id] = thread
-                thread.start()
-    
-    def update_regenerated_response(self, message_widget, conversation_id, text):
-        """更新重新生成的回答"""
-        if self.current_conversation and conversation_id == self.current_conversation.id:
-            message_widget.update_content(text)
-            
-            # 更新对话历史
-            if self.current_conversation.messages and self.current_conversation.messages[-1]['role'] == 'assistant':
-                self.current_conversation.messages[-1]['content'] = text
-            
-            # 保存对话
-            self.conversation_list.save_conversations()
+        """重新生成回答：并发生成多个候选，作为新分支保存，原来的回答仍然保留"""
+        conversation = self.current_conversation
+        if not conversation:
+            return
+        # 回答还在生成时不能重新生成，否则后续的流式输出会写进新的候选
+        if conversation.id in self.streaming:
+            return
+        position = self.chat_display.message_index(message_widget)
+        if position < 0 or conversation.messages[position]['role'] != 'assistant':
+            return
+        if self.regenerate_thread is not None:
+            self.regenerate_thread.stop()
+            self.regenerate_thread.wait()
+        
+        # 每个候选都是 position 处的一个新分支，共享之前的历史
+        history = [plain_message(msg) for msg in conversation.messages[:position]]
+        candidates = [{'role': 'assistant', 'content': ''} for _ in range(self.candidates_spin.value())]
+        first_index = None
+        for candidate in candidates:
+            index = conversation.add_branch(position, [candidate])
+            if first_index is None:
+                first_index = index
+        conversation.switch_branch(position, first_index)
+        conversation.touch()
+        self.display_messages(position)
+        self.sync_thread_history(conversation)
+        self.conversation_list.save_conversations()
+        
+        thread = RegenerateThread(
+            self.model_combo.currentText(),
+            history,
+            len(candidates),
+            self.image_store,
+            self.chat
+        )
+        thread.candidate_updated.connect(
+            lambda index, text: self.update_candidate(conversation, position, candidates[index], text)
+        )
+        thread.candidate_finished.connect(lambda index: self.save_candidate(conversation))
+        # 所有候选生成完之前对话处于忙碌状态，不能发送消息或再次重新生成
+        self.pending_candidates[conversation.id] = len(candidates)
+        self.streaming.add(conversation.id)
+        self.update_send_button()
+        self.regenerate_thread = thread
+        thread.start()
+    
+    def update_candidate(self, conversation, position, candidate, text):
+        """更新候选回答，当前显示的分支同时刷新界面"""
+        candidate['content'] = text
+        if position < len(conversation.messages) and conversation.messages[position] is candidate:
+            # 当前分支上的候选，同步到对话线程，生成结束后发送的消息基于最新的回答
+            self.sync_thread_history(conversation)
+            message_widget = self.chat_display.message_widget(position)
+            if conversation is self.current_conversation and message_widget is not None:
+                message_widget.update_content(text)
+    
+    def save_candidate(self, conversation):
+        """候选回答完成后保存，未显示的分支也需要写入；全部完成后对话不再忙碌"""
+        conversation.touch()
+        self.conversation_list.save_conversations()
+        self.pending_candidates[conversation.id] -= 1
+        if not self.pending_candidates[conversation.id]:
+            del self.pending_candidates[conversation.id]
+            self.streaming.discard(conversation.id)
+            self.update_send_button()
+    
+    def switch_branch(self, message_widget, delta):
+        """切换到上一个或下一个候选回答，已渲染过的分支直接复用"""
+        conversation = self.current_conversation
+        position = self.chat_display.message_index(message_widget)
+        if not conversation or position < 0 or conversation.id in self.streaming:
+            return
+        index, count = conversation.sibling_info(position)
+        if count < 2:
+            return
+        conversation.switch_branch(position, index + delta)
+        self.display_messages(position)
+        self.sync_thread_history(conversation)
+        self.conversation_list.save_conversations()
+    
+    def sync_thread_history(self, conversation):
+        """让对话线程使用当前分支的历史"""
+        thread = self.chat_threads.get(conversation.id)
+        if thread is not None:
+            thread.set_history(conversation.messages)
+    
+    def open_compare_window(self):
+        """打开多模型对比窗口，带入当前输入框中的问题"""
+        models = [self.model_combo.itemText(i) for i in range(self.model_combo.count())]
+        if self.compare_window is not None:
+            self.compare_window.close()
+        self.compare_window = CompareWindow(models, self.input_field.text().strip(), self.chat)
+        self.compare_window.show()
     
     def refresh_models(self):
         """刷新模型列表"""
@@ -0,0 +1,256 @@
+"""多个 Ollama 服务器之间的负载均衡
+
+在 endpoints.json 中配置服务器池:
+    {
+        "pools": {
+            "default": {"hosts": ["http://127.0.0.1:11434", "http://10.0.0.2:11434"], "max_concurrency": 2,
+                        "memory_gb": 24},
+            "vision": {"hosts": ["http://10.0.0.3:11434"]}
+        },
+        "models": {"llama3.2-vision": "vision"}
+    }
+models 按模型名前缀指定使用的池，未匹配的模型使用 default 池（没有时使用第一个池）。
+memory_gb 为池中每台服务器可用于加载模型的内存，多模型对比按它分批，未配置时使用本机的内存预算。
+也可以用环境变量 CHATOLLAMA_ENDPOINTS 指定逗号分隔的服务器地址，组成一个 default 池。
+两者都没有时返回 None，直接使用 ollama 库的默认服务器。
+"""
+import json
+import os
+import threading
+
+import httpx
+import ollama
+
+ENDPOINTS_FILE = 'endpoints.json'
+HEALTH_INTERVAL = 10  # 健康检查间隔（秒）
+HEALTH_TIMEOUT = 3  # 健康检查请求超时（秒）
+# 对话请求的超时：连接超时与健康检查相同，读取超时放宽到能覆盖加载大模型的时间
+CHAT_TIMEOUT = httpx.Timeout(600, connect=HEALTH_TIMEOUT)
+# 说明服务器本身不可用的异常，其他异常（例如请求参数错误）与服务器无关，直接交给调用方
+TRANSPORT_ERRORS = (ConnectionError, TimeoutError, httpx.TransportError)
+
+def model_name(info):
+    # 新版 ollama 库使用 model 字段，旧版使用 name 字段
+    return info.get('model') or info.get('name')
+
+def normalize_model(model):
+    """补全默认标签，llama3.2 与 llama3.2:latest 视为同一个模型"""
+    return model if ':' in model else model + ':latest'
+
+class Endpoint:
+    """一个 Ollama 服务器"""
+    def __init__(self, host, max_concurrency=1):
+        self.host = host
+        self.max_concurrency = max_concurrency
+        self.client = ollama.Client(host=host, timeout=CHAT_TIMEOUT)
+        self.health_client = ollama.Client(host=host, timeout=HEALTH_TIMEOUT)
+        self.healthy = True  # 首次检查之前视为可用
+        self.models = None  # 已安装的模型，未知时为 None
+        self.sizes = {}  # 已安装模型的大小（字节）
+        self.loaded = set()  # 已加载到内存中的模型
+        self.in_flight = 0
+
+    def has_model(self, model):
+        return self.models is None or normalize_model(model) in self.models
+
+    def check(self):
+        """查询已安装模型的大小和已加载的模型，服务器不可用时返回 None"""
+        try:
+            sizes = {normalize_model(model_name(info)): info.get('size')
+                     for info in self.health_client.list()['models']}
+            loaded = {normalize_model(model_name(info)) for info in self.health_client.ps()['models']}
+        except Exception:
+            return None
+        return sizes, loaded
+
+class EndpointPool:
+    """一组可以互相替代的服务器
+
+    每个请求优先发往已经加载了该模型、且当前请求数最少的服务器；所有服务器都满载时排队等待。
+    排队中的请求每次被唤醒都会重新选择服务器，服务器宕机后会自动改用其他服务器。
+    """
+    def __init__(self, name, endpoints, memory_budget=None):
+        self.name = name
+        self.endpoints = endpoints
+        self.memory_budget = memory_budget  # 每台服务器的内存预算（字节），未配置时为 None
+        self.condition = threading.Condition()
+        self.checked = threading.Event()  # 完成第一次健康检查后设置
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._health_loop, name=f"EndpointPool-{name}", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def check_health(self):
+        """检查所有服务器，更新可用状态和模型分布"""
+        for endpoint in self.endpoints:
+            result = endpoint.check()
+            with self.condition:
+                if result is None:
+                    endpoint.healthy = False
+                else:
+                    sizes, endpoint.loaded = result
+                    endpoint.healthy = True
+                    endpoint.models = set(sizes)
+                    endpoint.sizes = {model: size for model, size in sizes.items() if size}
+                self.condition.notify_all()
+        self.checked.set()
+
+    def models(self):
+        """所有可用服务器上已安装的模型"""
+        with self.condition:
+            return set().union(*(endpoint.models or () for endpoint in self.endpoints if endpoint.healthy))
+
+    def model_state(self):
+        """可用服务器上模型的大小和已加载的模型，用于多模型对比的分批"""
+        with self.condition:
+            sizes = {}
+            loaded = set()
+            for endpoint in self.endpoints:
+                if endpoint.healthy:
+                    sizes.update(endpoint.sizes)
+                    loaded |= endpoint.loaded
+            return sizes, loaded
+
+    def chat(self, model, messages, **params):
+        """发起流式请求，逐块返回 Ollama 的原始响应，params 为 options、format 等请求参数
+
+        连接失败或服务器上没有该模型时，在产生任何输出之前自动换一台服务器重试。
+        只有连接错误和超时会把服务器标记为不可用，其他异常原样抛出。
+        """
+        tried = set()
+        while True:
+            endpoint = self._acquire(model, tried)
+            if endpoint is None:
+                raise ConnectionError(f"没有可用的 Ollama 服务器可以运行模型 {model}")
+            started = False
+            try:
+                for chunk in endpoint.client.chat(model=model, messages=messages, stream=True, **params):
+                    started = True
+                    yield chunk
+                with self.condition:
+                    endpoint.loaded.add(normalize_model(model))
+                return
+            except ollama.ResponseError as e:
+                if started or e.status_code != 404:
+                    raise
+                # 该服务器上没有这个模型
+                with self.condition:
+                    if endpoint.models is not None:
+                        endpoint.models.discard(normalize_model(model))
+                tried.add(endpoint)
+            except TRANSPORT_ERRORS:
+                self._mark_down(endpoint)
+                if started:
+                    raise
+                tried.add(endpoint)
+            finally:
+                self._release(endpoint)
+
+    def _acquire(self, model, exclude):
+        with self.condition:
+            while True:
+                candidates = [endpoint for endpoint in self.endpoints
+                              if endpoint.healthy and endpoint.has_model(model) and endpoint not in exclude]
+                if not candidates:
+                    return None
+                free = [endpoint for endpoint in candidates if endpoint.in_flight < endpoint.max_concurrency]
+                if free:
+                    endpoint = min(free, key=lambda e: (normalize_model(model) not in e.loaded,
+                                                        e.in_flight / e.max_concurrency))
+                    endpoint.in_flight += 1
+                    return endpoint
+                # 全部满载，等待有请求结束或健康状态变化
+                self.condition.wait(HEALTH_INTERVAL)
+
+    def _release(self, endpoint):
+        with self.condition:
+            endpoint.in_flight -= 1
+            self.condition.notify_all()
+
+    def _mark_down(self, endpoint):
+        with self.condition:
+            endpoint.healthy = False
+            self.condition.notify_all()
+
+    def _health_loop(self):
+        self.check_health()
+        while not self._stop_event.wait(HEALTH_INTERVAL):
+            self.check_health()
+
+class EndpointRouter:
+    """按模型把请求分配到不同的服务器池"""
+    def __init__(self, pools, model_pools=None):
+        self.pools = pools
+        self.model_pools = model_pools or {}
+
+    @classmethod
+    def from_config(cls, config):
+        pools = {}
+        for name, pool_config in config['pools'].items():
+            max_concurrency = pool_config.get('max_concurrency', 1)
+            memory_gb = pool_config.get('memory_gb')
+            pools[name] = EndpointPool(
+                name,
+                [Endpoint(host, max_concurrency) for host in pool_config['hosts']],
+                int(memory_gb * 1024 ** 3) if memory_gb else None
+            )
+        return cls(pools, config.get('models'))
+
+    def start(self):
+        for pool in self.pools.values():
+            pool.start()
+
+    def stop(self):
+        for pool in self.pools.values():
+            pool.stop()
+
+    def check_health(self):
+        for pool in self.pools.values():
+            pool.check_health()
+
+    def wait_checked(self):
+        """等待各个池完成第一次健康检查，之后直接返回，状态由后台的定期检查更新"""
+        for pool in self.pools.values():
+            pool.checked.wait()
+
+    def pool_for(self, model):
+        for prefix, pool_name in self.model_pools.items():
+            if model.startswith(prefix):
+                return self.pools[pool_name]
+        return self.pools.get('default') or next(iter(self.pools.values()))
+
+    def chat(self, model, messages, **params):
+        return self.pool_for(model).chat(model, messages, **params)
+
+    def models(self):
+        return sorted(set().union(*(pool.models() for pool in self.pools.values())))
+
+_router = None
+_router_lock = threading.Lock()
+
+def load_config(path=ENDPOINTS_FILE):
+    """读取服务器池配置，没有配置时返回 None"""
+    hosts = os.environ.get('CHATOLLAMA_ENDPOINTS')
+    if hosts:
+        return {'pools': {'default': {'hosts': [host.strip() for host in hosts.split(',') if host.strip()]}}}
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    return None
+
+def get_router():
+    """获取全局的请求路由，第一次调用时读取配置并启动健康检查"""
+    global _router
+    with _router_lock:
+        if _router is None:
+            config = load_config()
+            if config is None:
+                _router = False
+            else:
+                _router = EndpointRouter.from_config(config)
+                _router.start()
+        return _router or None
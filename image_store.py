@@ -0,0 +1,136 @@
+import base64
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageOps
+
+IMAGES_DIR = 'images'
+DEFAULT_IMAGE_SIZE = 1024
+# 各视觉模型的输入边长（像素），按模型名前缀匹配，图片长边超过时会被缩小
+MODEL_IMAGE_SIZES = {
+    'llama3.2-vision': 1120,
+    'llava': 672,
+    'minicpm-v': 1344,
+    'moondream': 378,
+}
+BASE64_CACHE_SIZE = 64
+HASH_CHARS = set('0123456789abcdef')
+
+def is_image_key(value):
+    """判断消息里的图片是否为 ImageStore 的哈希（否则是直接写入的 base64 编码）"""
+    return len(value) == 64 and set(value) <= HASH_CHARS
+
+def image_size_for_model(model):
+    """获取模型的图片输入边长"""
+    for prefix, size in MODEL_IMAGE_SIZES.items():
+        if model.startswith(prefix):
+            return size
+    return DEFAULT_IMAGE_SIZE
+
+class ImageStore:
+    """按内容哈希保存预处理后的图片
+
+    图片的解码、缩放和编码都在线程池中完成。消息里只保存图片的哈希，
+    发送请求时从内存缓存中取出 base64 编码，同一张图片不会被重复处理或保存。
+    """
+    def __init__(self, directory=IMAGES_DIR, max_workers=2):
+        self.directory = directory
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._base64_cache = OrderedDict()  # 哈希 -> base64 字符串，按最近使用排序
+        self._lock = threading.Lock()
+
+    def submit(self, path, model):
+        """在线程池中处理图片，返回 Future，结果为图片哈希"""
+        return self.executor.submit(self.prepare, path, image_size_for_model(model))
+
+    def prepare(self, path, size):
+        """把图片缩放到 size 以内并保存，返回图片哈希；相同内容和尺寸的图片只处理一次"""
+        with open(path, 'rb') as f:
+            source = f.read()
+        key = hashlib.sha256(source + str(size).encode()).hexdigest()
+        target = self._path(key)
+        if os.path.exists(target):
+            return key
+
+        img = ImageOps.exif_transpose(Image.open(io.BytesIO(source))).convert('RGB')
+        img.thumbnail((size, size), Image.Resampling.LANCZOS)
+        buffer = io.BytesIO()
+        img.save(buffer, format='JPEG', quality=90)
+        data = buffer.getvalue()
+
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = target + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, target)
+        self._remember(key, base64.b64encode(data).decode('ascii'))
+        return key
+
+    def add_base64(self, encoded):
+        """保存已经 base64 编码的图片（例如批量模式导入的请求），返回图片哈希
+
+        图片按原样保存，不做缩放，相同内容的图片只保存一次。
+        """
+        data = base64.b64decode(encoded)
+        key = hashlib.sha256(data).hexdigest()
+        target = self._path(key)
+        if not os.path.exists(target):
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = target + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, target)
+        self._remember(key, encoded)
+        return key
+
+    def import_messages(self, messages):
+        """把消息中 base64 编码的图片保存下来并替换为哈希，返回新的消息列表"""
+        imported = []
+        for msg in messages:
+            if msg.get('images'):
+                msg = dict(msg, images=[key if is_image_key(key) else self.add_base64(key)
+                                        for key in msg['images']])
+            imported.append(msg)
+        return imported
+
+    def get_base64(self, key):
+        """获取图片的 base64 编码，优先使用内存缓存"""
+        with self._lock:
+            encoded = self._base64_cache.get(key)
+            if encoded is not None:
+                self._base64_cache.move_to_end(key)
+                return encoded
+        with open(self._path(key), 'rb') as f:
+            encoded = base64.b64encode(f.read()).decode('ascii')
+        self._remember(key, encoded)
+        return encoded
+
+    def resolve_messages(self, messages):
+        """把消息中的图片哈希替换为 base64 编码，生成可直接发送给 Ollama 的消息列表
+
+        早期导入的对话里可能直接保存了 base64 编码，这类图片原样发送。
+        """
+        resolved = []
+        for msg in messages:
+            if msg.get('images'):
+                msg = dict(msg, images=[self.get_base64(key) if is_image_key(key) else key
+                                        for key in msg['images']])
+            resolved.append(msg)
+        return resolved
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.jpg')
+
+    def _remember(self, key, encoded):
+        with self._lock:
+            self._base64_cache[key] = encoded
+            self._base64_cache.move_to_end(key)
+            while len(self._base64_cache) > BASE64_CACHE_SIZE:
+                self._base64_cache.popitem(last=False)
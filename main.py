@@ -1,8 +1,9 @@
 import sys
 from PyQt6.QtWidgets import QApplication, QSystemTrayIcon, QMenu
 from PyQt6.QtGui import QIcon, QAction
-from PyQt6.QtCore import Qt
-from chat_ui import ChatWindow
+from PyQt6.QtCore import Qt, QTimer
+from chat_ui import ChatWindow, StallDebugPanel
+from stall_monitor import StallMonitor
 import os
 
 class MenuBarApp:
@@ -27,6 +28,22 @@ class MenuBarApp:
         quit_action.triggered.connect(self.quit_app)
         
         self.menu.addAction(show_action)
+        
+        # 界面卡顿监测：定时器在界面线程上发心跳，卡顿时由监测线程采样调用栈
+        self.stall_monitor = StallMonitor.from_env()
+        self.stall_panel = None
+        if self.stall_monitor:
+            self.stall_panel = StallDebugPanel()
+            self.stall_monitor.listeners.append(self.stall_panel.stall_detected.emit)
+            self.heartbeat = QTimer()
+            self.heartbeat.timeout.connect(self.stall_monitor.beat)
+            self.heartbeat.start(int(self.stall_monitor.interval * 1000))
+            self.stall_monitor.start()
+            
+            stall_action = QAction("卡顿记录", self.menu)
+            stall_action.triggered.connect(self.stall_panel.show)
+            self.menu.addAction(stall_action)
+        
         self.menu.addSeparator()
         self.menu.addAction(quit_action)
         
@@ -72,6 +89,8 @@ class MenuBarApp:
     
     def quit_app(self):
         self.window.close()
+        if self.stall_monitor:
+            self.stall_monitor.stop()
         self.app.quit()
 
 if __name__ == "__main__":
@@ -0,0 +1,434 @@
+"""本地代理服务：对外提供 Ollama / OpenAI 兼容的对话接口
+
+其他工具把 Ollama 地址改成代理地址后，请求会经过与聊天窗口相同的请求路径
+（包括多服务器负载均衡），并统一进行响应缓存和并发限制。
+
+单独启动:
+    python proxy.py --port 11435 --record
+
+或随后台服务一起启动:
+    python backend.py --proxy-port 11435 --record-proxy
+
+支持的接口:
+    POST /api/chat              Ollama 对话接口（默认流式）
+    POST /v1/chat/completions   OpenAI 对话接口（stream 为 true 时使用 SSE）
+    GET  /api/tags, /v1/models  模型列表
+请求头带 Cache-Control: no-cache 时跳过缓存。
+Ollama 请求的 options、format、keep_alive，以及 OpenAI 请求的 temperature、max_tokens、
+response_format 等参数会转换后传给 Ollama，并作为缓存键的一部分；暂不支持 tools。
+"""
+import argparse
+import hashlib
+import json
+import sys
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+
+import backend  # backend 也导入本模块，这里只导入模块本身，用到时再取其中的属性
+from chat_core import Conversation, ModelManager, stream_chat
+
+DEFAULT_PORT = 11435
+CACHE_SIZE = 256
+
+# OpenAI 参数名 -> Ollama options 中的参数名
+OPENAI_OPTIONS = {
+    'temperature': 'temperature',
+    'top_p': 'top_p',
+    'max_tokens': 'num_predict',
+    'max_completion_tokens': 'num_predict',
+    'stop': 'stop',
+    'seed': 'seed',
+    'frequency_penalty': 'frequency_penalty',
+    'presence_penalty': 'presence_penalty',
+}
+OLLAMA_PARAMS = ('options', 'format', 'keep_alive')
+
+def cache_key(model, messages, params=None):
+    data = json.dumps({'model': model, 'messages': messages, 'params': params or {}},
+                      ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+class ProxyEngine:
+    """代理的请求处理：响应缓存、相同请求合并以及并发限制"""
+    def __init__(self, chat=stream_chat, max_concurrency=4, per_model=2, cache_size=CACHE_SIZE, recorder=None):
+        self.chat = chat
+        self.cache_size = cache_size
+        self.recorder = recorder  # 生成完成后调用 recorder(model, messages, response)
+        self.per_model = per_model
+        self._cache = OrderedDict()  # key -> (文本块列表, 统计信息)
+        self._in_flight = {}  # key -> 正在生成的请求完成时触发的 Event
+        self._global_slots = threading.BoundedSemaphore(max_concurrency)
+        self._model_slots = {}
+        self._lock = threading.Lock()
+
+    def generate(self, model, messages, stats, use_cache=True, record=True, **params):
+        """逐块返回回复文本，stats 会写入 Ollama 返回的统计信息，params 原样传给 Ollama
+
+        相同的请求（包括参数）直接使用缓存；相同的请求正在生成时，等它完成后复用结果。
+        use_cache 为 False 时只进行并发限制；record 为 False 时不交给 recorder 记录。
+        """
+        key = cache_key(model, messages, params)
+        leader = False
+        if use_cache:
+            with self._lock:
+                cached = self._cache.get(key)
+                if cached is not None:
+                    self._cache.move_to_end(key)
+                else:
+                    flight = self._in_flight.get(key)
+                    if flight is None:
+                        self._in_flight[key] = threading.Event()
+                        leader = True
+            if cached is not None:
+                stats.update(cached[1])
+                stats['cached'] = True
+                yield from cached[0]
+                return
+            if not leader:
+                flight.wait()
+                yield from self.generate(model, messages, stats, use_cache, record, **params)
+                return
+
+        chunks = []
+        complete = False
+        try:
+            with self._model_slot(model), self._global_slots:
+                for text in self.chat(model, messages, stats, **params):
+                    chunks.append(text)
+                    yield text
+            complete = True
+        finally:
+            if leader:
+                with self._lock:
+                    if complete:
+                        self._cache[key] = (chunks, dict(stats))
+                        while len(self._cache) > self.cache_size:
+                            self._cache.popitem(last=False)
+                    self._in_flight.pop(key).set()
+        if complete and record and self.recorder is not None:
+            try:
+                self.recorder(model, messages, ''.join(chunks))
+            except Exception as e:
+                print(f"记录代理对话失败: {e}")
+
+    def _model_slot(self, model):
+        with self._lock:
+            slot = self._model_slots.get(model)
+            if slot is None:
+                slot = self._model_slots[model] = threading.BoundedSemaphore(self.per_model)
+            return slot
+
+# 以下转换函数遇到格式错误的请求时抛出 ValueError，由 ProxyHandler 返回 400
+
+def check_messages(messages):
+    """检查消息列表的基本结构：每条消息都是带有字符串 role 的对象"""
+    if not isinstance(messages, list):
+        raise ValueError("messages must be an array")
+    for i, msg in enumerate(messages):
+        if not isinstance(msg, dict) or not isinstance(msg.get('role'), str):
+            raise ValueError(f"messages[{i}] must be an object with a string role")
+    return messages
+
+def ollama_messages(messages):
+    """检查 Ollama 格式的消息，content 必须是字符串，images 必须是字符串数组"""
+    for i, msg in enumerate(check_messages(messages)):
+        if not isinstance(msg.get('content', ''), str):
+            raise ValueError(f"messages[{i}].content must be a string")
+        images = msg.get('images')
+        if images is not None and not (isinstance(images, list) and all(isinstance(image, str) for image in images)):
+            raise ValueError(f"messages[{i}].images must be an array of strings")
+    return messages
+
+def ollama_params(request):
+    """Ollama 请求中需要原样转发的参数"""
+    if request.get('options') is not None and not isinstance(request['options'], dict):
+        raise ValueError("options must be an object")
+    return {name: request[name] for name in OLLAMA_PARAMS if request.get(name) is not None}
+
+def openai_params(request):
+    """把 OpenAI 请求的采样参数和 response_format 转换为 Ollama 的 options 和 format"""
+    options = {}
+    for name, option in OPENAI_OPTIONS.items():
+        value = request.get(name)
+        if value is not None:
+            options[option] = [value] if name == 'stop' and isinstance(value, str) else value
+    params = {'options': options} if options else {}
+    response_format = request.get('response_format') or {}
+    if not isinstance(response_format, dict):
+        raise ValueError("response_format must be an object such as {\"type\": \"text\"}")
+    if response_format.get('type') == 'json_object':
+        params['format'] = 'json'
+    elif response_format.get('type') == 'json_schema':
+        json_schema = response_format.get('json_schema') or {}
+        if not isinstance(json_schema, dict):
+            raise ValueError("response_format.json_schema must be an object")
+        params['format'] = json_schema.get('schema') or 'json'
+    return params
+
+def openai_messages(messages):
+    """把 OpenAI 格式的消息转换为 Ollama 格式（多段内容合并为文本，data URL 图片转为 images）"""
+    converted = []
+    for i, msg in enumerate(check_messages(messages)):
+        content = msg.get('content') or ''
+        images = []
+        if isinstance(content, list):
+            texts = []
+            for part in content:
+                if not isinstance(part, dict):
+                    raise ValueError(f"messages[{i}].content parts must be objects")
+                if part.get('type') == 'text':
+                    texts.append(str(part.get('text', '')))
+                elif part.get('type') == 'image_url':
+                    image_url = part.get('image_url')
+                    url = image_url.get('url') if isinstance(image_url, dict) else image_url
+                    if not isinstance(url, str):
+                        raise ValueError(f"messages[{i}] has an image_url part without a url")
+                    if url.startswith('data:') and ',' in url:
+                        images.append(url.split(',', 1)[1])
+            content = '\n'.join(texts)
+        elif not isinstance(content, str):
+            raise ValueError(f"messages[{i}].content must be a string or an array")
+        ollama_msg = {'role': msg['role'], 'content': content}
+        if images:
+            ollama_msg['images'] = images
+        converted.append(ollama_msg)
+    return converted
+
+class ProxyHandler(BaseHTTPRequestHandler):
+    """处理单个 HTTP 请求"""
+    def do_GET(self):
+        models = ModelManager.get_local_models()
+        if self.path == '/api/tags':
+            self.send_json({'models': [{'name': model, 'model': model} for model in models]})
+        elif self.path == '/v1/models':
+            self.send_json({'object': 'list', 'data': [
+                {'id': model, 'object': 'model', 'created': 0, 'owned_by': 'ollama'} for model in models
+            ]})
+        else:
+            self.send_json({'error': "not found"}, 404)
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError as e:
+            self.send_json({'error': f"invalid request: {e}"}, 400)
+            return
+        if not isinstance(request, dict) or 'model' not in request or 'messages' not in request:
+            self.send_json({'error': "model and messages are required"}, 400)
+            return
+        if not isinstance(request['model'], str):
+            self.send_json({'error': "model must be a string"}, 400)
+            return
+        if request.get('tools'):
+            # 代理只转发文本回复，工具调用的结果无法返回给客户端
+            self.send_json({'error': "tools are not supported by this proxy"}, 400)
+            return
+        use_cache = 'no-cache' not in self.headers.get('Cache-Control', '')
+        if self.path not in ('/api/chat', '/v1/chat/completions'):
+            self.send_json({'error': "not found"}, 404)
+            return
+        try:
+            if self.path == '/api/chat':
+                messages, params = ollama_messages(request['messages']), ollama_params(request)
+            else:
+                messages, params = openai_messages(request['messages']), openai_params(request)
+        except ValueError as e:
+            self.send_json({'error': f"invalid request: {e}"}, 400)
+            return
+        if self.path == '/api/chat':
+            self.handle_ollama_chat(request, messages, params, use_cache)
+        else:
+            self.handle_openai_chat(request, messages, params, use_cache)
+
+    def handle_ollama_chat(self, request, messages, params, use_cache):
+        model = request['model']
+        stats = {}
+        chunks = self.server.engine.generate(model, messages, stats, use_cache, **params)
+
+        def message(content, done):
+            data = {
+                'model': model,
+                'created_at': datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z'),
+                'message': {'role': 'assistant', 'content': content},
+                'done': done,
+            }
+            if done:
+                data['done_reason'] = 'stop'
+                data.update((k, v) for k, v in stats.items() if k != 'cached')
+            return data
+
+        try:
+            if request.get('stream', True):
+                self.start_stream('application/x-ndjson')
+                for text in chunks:
+                    if text:
+                        self.write_line(json.dumps(message(text, False), ensure_ascii=False))
+                self.write_line(json.dumps(message('', True), ensure_ascii=False))
+            else:
+                self.send_json(message(''.join(chunks), True))
+        except (BrokenPipeError, ConnectionResetError):
+            chunks.close()
+        except Exception as e:
+            self.send_error_safely(e)
+
+    def handle_openai_chat(self, request, messages, params, use_cache):
+        model = request['model']
+        stats = {}
+        chunks = self.server.engine.generate(model, messages, stats, use_cache, **params)
+        completion_id = f"chatcmpl-{next(self.server.request_ids)}"
+        created = int(time.time())
+
+        def chunk_data(delta, finish_reason=None):
+            return {
+                'id': completion_id,
+                'object': 'chat.completion.chunk',
+                'created': created,
+                'model': model,
+                'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}],
+            }
+
+        try:
+            if request.get('stream', False):
+                self.start_stream('text/event-stream')
+                first = True
+                for text in chunks:
+                    if not text:
+                        continue
+                    delta = {'role': 'assistant', 'content': text} if first else {'content': text}
+                    first = False
+                    self.write_line(f"data: {json.dumps(chunk_data(delta), ensure_ascii=False)}\n")
+                self.write_line(f"data: {json.dumps(chunk_data({}, 'stop'), ensure_ascii=False)}\n")
+                self.write_line("data: [DONE]\n")
+            else:
+                content = ''.join(chunks)
+                prompt_tokens = stats.get('prompt_eval_count', 0)
+                completion_tokens = stats.get('eval_count', 0)
+                self.send_json({
+                    'id': completion_id,
+                    'object': 'chat.completion',
+                    'created': created,
+                    'model': model,
+                    'choices': [{
+                        'index': 0,
+                        'message': {'role': 'assistant', 'content': content},
+                        'finish_reason': 'stop',
+                    }],
+                    'usage': {
+                        'prompt_tokens': prompt_tokens,
+                        'completion_tokens': completion_tokens,
+                        'total_tokens': prompt_tokens + completion_tokens,
+                    },
+                })
+        except (BrokenPipeError, ConnectionResetError):
+            chunks.close()
+        except Exception as e:
+            self.send_error_safely(e)
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def start_stream(self, content_type):
+        # HTTP/1.0 下不写 Content-Length，连接关闭即表示响应结束
+        self.send_response(200)
+        self.send_header('Content-Type', f'{content_type}; charset=utf-8')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.streaming = content_type
+
+    def write_line(self, line):
+        self.wfile.write((line + '\n').encode('utf-8'))
+        self.wfile.flush()
+
+    def send_error_safely(self, error):
+        """出错时返回错误信息，流式响应已经开始时写在最后一行（SSE 响应写成一个 data 事件）"""
+        streaming = getattr(self, 'streaming', None)
+        if streaming:
+            if streaming == 'text/event-stream':
+                data = {'error': {'message': str(error), 'type': 'server_error'}}
+                line = f"data: {json.dumps(data, ensure_ascii=False)}\n"
+            else:
+                line = json.dumps({'error': str(error)}, ensure_ascii=False)
+            try:
+                self.write_line(line)
+            except OSError:
+                pass
+        else:
+            self.send_json({'error': str(error)}, 502)
+
+    def log_message(self, format, *args):
+        pass  # 不在终端打印每个请求
+
+class ProxyServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, engine):
+        super().__init__(address, ProxyHandler)
+        self.engine = engine
+        self.request_ids = count(1)
+
+def conversation_recorder(save):
+    """生成把代理请求记录为对话的 recorder，save 接收 Conversation 列表"""
+    ids = count(1)
+    lock = threading.Lock()
+
+    def record(model, messages, response):
+        last = messages[-1].get('content', '') if messages else ''
+        with lock:
+            conv_id = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_proxy{next(ids):05d}"
+        conv = Conversation(conv_id, f"[{model}] {last[:20]}" + ('...' if len(last) > 20 else ''))
+        conv.messages = [{'role': msg['role'], 'content': msg.get('content', '')} for msg in messages]
+        conv.messages.append({'role': 'assistant', 'content': response})
+        with lock:
+            save([conv])
+
+    return record
+
+def add_arguments(parser, prefix=''):
+    """代理相关的命令行参数，后台服务也会使用"""
+    parser.add_argument(f'--{prefix}max-concurrency', type=int, default=4,
+                        help="同时向模型发起的最大请求数（默认 4）")
+    parser.add_argument(f'--{prefix}per-model', type=int, default=2,
+                        help="每个模型同时处理的最大请求数（默认 2）")
+    parser.add_argument(f'--{prefix}cache-size', type=int, default=CACHE_SIZE,
+                        help=f"缓存的响应数（默认 {CACHE_SIZE}）")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Ollama / OpenAI 兼容的本地代理")
+    parser.add_argument('--host', default='127.0.0.1', help="监听地址（默认 127.0.0.1）")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f"监听端口（默认 {DEFAULT_PORT}）")
+    parser.add_argument('--record', action='store_true',
+                        help="把请求记录到对话历史；设置了 CHATOLLAMA_BACKEND 时通过后台服务写入，"
+                             "否则直接写文件，请在聊天窗口未运行时使用")
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    recorder = None
+    if args.record:
+        try:
+            recorder = conversation_recorder(backend.open_conversation_store().add)
+        except backend.BackendError as e:
+            parser.error(str(e))
+    engine = ProxyEngine(max_concurrency=args.max_concurrency, per_model=args.per_model,
+                         cache_size=args.cache_size, recorder=recorder)
+    server = ProxyServer((args.host, args.port), engine)
+    print(f"代理已启动: http://{args.host}:{args.port}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
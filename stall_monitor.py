@@ -0,0 +1,117 @@
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from datetime import datetime, timedelta
+
+STALL_LOG_FILE = 'stalls.log'
+STACK_LIMIT = 30  # 每次采样保留的最内层栈帧数
+UPDATE_INTERVAL = 1.0  # 卡顿持续期间更新日志的间隔（秒）
+
+class StallMonitor:
+    """界面线程卡顿监测
+
+    界面线程通过定时器定期调用 beat，监测线程发现心跳超过阈值未更新时，
+    每隔 interval 秒采样一次界面线程的 Python 调用栈。卡顿一超过阈值就写入日志，
+    持续期间每隔 UPDATE_INTERVAL 秒用最新的采样改写这条记录，即使界面再也没有恢复
+    也能留下调用栈；卡顿结束后写入最终的持续时间，并通知监听者（例如调试面板）。
+    """
+    def __init__(self, threshold=0.25, interval=0.05, log_path=STALL_LOG_FILE, thread_id=None):
+        self.threshold = threshold
+        self.interval = interval
+        self.log_path = log_path
+        self.thread_id = thread_id or threading.main_thread().ident
+        self.listeners = []
+        self.last_beat = time.monotonic()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="StallMonitor", daemon=True)
+
+    @classmethod
+    def from_env(cls):
+        """根据环境变量 CHATOLLAMA_STALL_MS 创建监测器，设为 0 时返回 None"""
+        threshold_ms = float(os.environ.get('CHATOLLAMA_STALL_MS', 250))
+        if threshold_ms <= 0:
+            return None
+        return cls(threshold=threshold_ms / 1000)
+
+    def beat(self):
+        """心跳，需要在被监测的线程上定期调用"""
+        self.last_beat = time.monotonic()
+
+    def start(self):
+        self.beat()
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _run(self):
+        stall_start = None
+        samples = Counter()
+        log_offset = None  # 当前卡顿记录在日志文件中的起始位置
+        last_write = 0.0
+        while not self._stop_event.wait(self.interval):
+            last_beat = self.last_beat
+            now = time.monotonic()
+            if now - last_beat > self.threshold:
+                if stall_start is None:
+                    stall_start = last_beat
+                    samples = Counter()
+                    log_offset = None
+                frame = sys._current_frames().get(self.thread_id)
+                if frame is not None:
+                    samples[''.join(traceback.format_stack(frame, limit=STACK_LIMIT))] += 1
+                del frame
+                if log_offset is None or now - last_write >= UPDATE_INTERVAL:
+                    log_offset = self._write_log(self._event(stall_start, now, samples, True), log_offset)
+                    last_write = now
+            elif stall_start is not None:
+                # 心跳恢复，卡顿结束
+                event = self._event(stall_start, last_beat, samples, False)
+                self._write_log(event, log_offset)
+                for listener in self.listeners:
+                    listener(event)
+                stall_start = None
+
+    def _event(self, stall_start, stall_end, samples, ongoing):
+        return {
+            'time': datetime.now() - timedelta(seconds=time.monotonic() - stall_start),  # 卡顿开始时间
+            'duration': stall_end - stall_start,
+            'samples': sum(samples.values()),
+            'stacks': samples.most_common(),
+            'ongoing': ongoing,
+        }
+
+    def _write_log(self, event, offset=None):
+        """写入卡顿记录，offset 不为 None 时覆盖从该位置开始的上一版记录，返回记录的起始位置"""
+        data = format_stall(event).encode('utf-8')
+        try:
+            if offset is None:
+                with open(self.log_path, 'ab') as f:
+                    offset = f.tell()
+                    f.write(data)
+            else:
+                with open(self.log_path, 'r+b') as f:
+                    f.seek(offset)
+                    f.write(data)
+                    f.truncate()
+        except Exception as e:
+            print(f"写入卡顿日志失败: {e}")
+        return offset
+
+def format_stall(event):
+    """把卡顿事件格式化为文本，相同的调用栈合并并按出现次数排序"""
+    state = "，仍未恢复" if event.get('ongoing') else ""
+    lines = [
+        f"=== {event['time'].strftime('%Y-%m-%d %H:%M:%S')} 界面卡顿 {event['duration'] * 1000:.0f}ms"
+        f"（采样 {event['samples']} 次{state}）===\n"
+    ]
+    for stack, count in event['stacks']:
+        lines.append(f"--- {count}/{event['samples']} 次采样 ---\n")
+        lines.append(stack)
+    lines.append("\n")
+    return ''.join(lines)
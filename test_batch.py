@@ -0,0 +1,88 @@
+"""batch.py 中纯函数的测试
+
+运行: python -m unittest test_batch
+"""
+import base64
+import os
+import shutil
+import tempfile
+import unittest
+
+from batch import load_prompts, parse_concurrency, percentile, to_conversation
+from image_store import ImageStore, is_image_key
+
+class PercentileTest(unittest.TestCase):
+    def test_nearest_rank(self):
+        values = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
+        self.assertEqual(percentile(values, 50), 5)
+        self.assertEqual(percentile(values, 90), 9)
+        self.assertEqual(percentile(values, 99), 10)
+        self.assertEqual(percentile(values, 0), 1)
+
+    def test_small_and_empty(self):
+        self.assertEqual(percentile([], 50), 0.0)
+        self.assertEqual(percentile([3.5], 99), 3.5)
+
+class ParseConcurrencyTest(unittest.TestCase):
+    def test_default_and_per_model(self):
+        self.assertEqual(parse_concurrency(None), (1, {}))
+        self.assertEqual(parse_concurrency(['4']), (4, {}))
+        self.assertEqual(parse_concurrency(['2', 'llama3.2=8', 'qwen2.5:7b=3']),
+                         (2, {'llama3.2': 8, 'qwen2.5:7b': 3}))
+
+    def test_invalid_values(self):
+        for value in ('0', 'x', 'llama3.2=0', 'llama3.2=', 'llama3.2=a'):
+            with self.assertRaises(ValueError, msg=value):
+                parse_concurrency([value])
+
+class LoadPromptsTest(unittest.TestCase):
+    def load(self, text):
+        fd, path = tempfile.mkstemp(suffix='.jsonl')
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+        return load_prompts(path)
+
+    def test_prompt_and_messages(self):
+        prompts = self.load(
+            '{"prompt": "你好"}\n'
+            '\n'
+            '{"id": "b", "messages": [{"role": "user", "content": "hi"}], "models": ["m"]}\n'
+        )
+        self.assertEqual(prompts[0]['id'], '1')
+        self.assertEqual(prompts[0]['messages'], [{'role': 'user', 'content': '你好'}])
+        self.assertEqual(prompts[1]['id'], 'b')
+        self.assertEqual(prompts[1]['models'], ['m'])
+
+    def test_rejects_missing_or_empty_messages(self):
+        for line in ('{"id": "a"}', '{"messages": []}', '{"messages": "hi"}'):
+            with self.assertRaises(ValueError, msg=line):
+                self.load(line + '\n')
+
+class ToConversationTest(unittest.TestCase):
+    def test_base64_images_are_stored_as_hashes(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        image_store = ImageStore(directory)
+        self.addCleanup(image_store.shutdown)
+        encoded = base64.b64encode(b'not really a jpeg').decode('ascii')
+        result = {
+            'model': 'm',
+            'messages': [{'role': 'user', 'content': '这是什么', 'images': [encoded]}],
+            'response': '一张图片',
+        }
+
+        conv = to_conversation(result, 0, image_store)
+        key, = conv.messages[0]['images']
+        self.assertTrue(is_image_key(key))
+        self.assertEqual(result['messages'][0]['images'], [encoded])  # 原始结果不被修改
+        self.assertEqual(conv.messages[-1], {'role': 'assistant', 'content': '一张图片'})
+
+        # 新的 ImageStore 实例从磁盘读取，发送时还原为相同的 base64 编码
+        resolved = ImageStore(directory).resolve_messages(conv.messages)
+        self.assertEqual(resolved[0]['images'], [encoded])
+        # 早期直接保存了 base64 的消息原样发送
+        self.assertEqual(image_store.resolve_messages(result['messages'])[0]['images'], [encoded])
+
+if __name__ == '__main__':
+    unittest.main()
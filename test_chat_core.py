@@ -0,0 +1,217 @@
+"""chat_core.py 的测试
+
+运行: python -m unittest test_chat_core
+"""
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import chat_core
+from chat_core import Conversation, ConversationStore, plan_compare_waves, plan_model_waves
+from endpoints import Endpoint, EndpointPool, EndpointRouter
+
+GB = 1024 ** 3
+OLD = "20000101_000000"  # 远早于归档期限的时间
+
+def make_conversation(conv_id, updated_at=OLD):
+    conv = Conversation(conv_id, f"对话 {conv_id}")
+    conv.messages = [{'role': 'user', 'content': f"问题 {conv_id}"},
+                     {'role': 'assistant', 'content': f"回答 {conv_id}"}]
+    conv.updated_at = updated_at
+    return conv
+
+def message(role, content):
+    return {'role': role, 'content': content}
+
+class ConversationBranchTest(unittest.TestCase):
+    def make_conversation(self):
+        conv = Conversation('c', "分支")
+        conv.messages = [message('user', 'q1'), message('assistant', 'a1'),
+                         message('user', 'q2'), message('assistant', 'a2')]
+        return conv
+
+    def contents(self, conv):
+        return [msg['content'] for msg in conv.messages]
+
+    def test_add_branch_keeps_current_branch(self):
+        conv = self.make_conversation()
+        self.assertEqual(conv.add_branch(3, [message('assistant', 'b2')]), 1)
+        self.assertEqual(conv.add_branch(3, [message('assistant', 'c2')]), 2)
+        self.assertEqual(self.contents(conv), ['q1', 'a1', 'q2', 'a2'])
+        self.assertEqual(conv.sibling_info(3), (0, 3))
+        self.assertEqual([head['content'] for head in conv.branch_heads(3)], ['a2', 'b2', 'c2'])
+
+    def test_add_branch_at_end_appends(self):
+        conv = self.make_conversation()
+        self.assertEqual(conv.add_branch(4, [message('user', 'q3')]), 0)
+        self.assertEqual(self.contents(conv), ['q1', 'a1', 'q2', 'a2', 'q3'])
+        self.assertEqual(conv.sibling_info(4), (0, 1))
+
+    def test_switch_branch_wraps_around(self):
+        conv = self.make_conversation()
+        conv.add_branch(3, [message('assistant', 'b2')])
+        conv.add_branch(3, [message('assistant', 'c2')])
+        conv.switch_branch(3, -1)
+        self.assertEqual(self.contents(conv), ['q1', 'a1', 'q2', 'c2'])
+        self.assertEqual(conv.sibling_info(3), (2, 3))
+        conv.switch_branch(3, 3)
+        self.assertEqual(self.contents(conv), ['q1', 'a1', 'q2', 'a2'])
+        self.assertEqual(conv.sibling_info(3), (0, 3))
+        conv.switch_branch(3, 4)
+        self.assertEqual(self.contents(conv), ['q1', 'a1', 'q2', 'b2'])
+        # 当前分支之外的分支只保存在当前分支的第一条消息上
+        self.assertEqual(sum('siblings' in msg for msg in conv.messages), 1)
+
+    def test_branch_in_the_middle_keeps_each_suffix(self):
+        conv = self.make_conversation()
+        index = conv.add_branch(1, [message('assistant', 'b1'), message('user', 'r2')])
+        conv.switch_branch(1, index)
+        self.assertEqual(self.contents(conv), ['q1', 'b1', 'r2'])
+        self.assertEqual(conv.sibling_info(1), (1, 2))
+        conv.switch_branch(1, 0)
+        self.assertEqual(self.contents(conv), ['q1', 'a1', 'q2', 'a2'])
+        self.assertEqual(conv.sibling_info(1), (0, 2))
+
+    def test_nested_branches_survive_switching(self):
+        conv = self.make_conversation()
+        conv.add_branch(3, [message('assistant', 'b2')])
+        index = conv.add_branch(1, [message('assistant', 'x1')])
+        conv.switch_branch(1, index)
+        conv.switch_branch(1, 0)
+        self.assertEqual(self.contents(conv), ['q1', 'a1', 'q2', 'a2'])
+        self.assertEqual(conv.sibling_info(3), (0, 2))
+        conv.switch_branch(3, 1)
+        self.assertEqual(self.contents(conv), ['q1', 'a1', 'q2', 'b2'])
+
+    def test_round_trip_keeps_branches(self):
+        conv = self.make_conversation()
+        conv.add_branch(3, [message('assistant', 'b2')])
+        conv.switch_branch(3, 1)
+
+        restored = Conversation.from_dict(json.loads(json.dumps(conv.to_dict())))
+        self.assertEqual(restored.id, conv.id)
+        self.assertEqual(restored.title, conv.title)
+        self.assertEqual(restored.updated_at, conv.updated_at)
+        self.assertEqual(restored.messages, conv.messages)
+        self.assertEqual(restored.sibling_info(3), (1, 2))
+        restored.switch_branch(3, 0)
+        self.assertEqual(self.contents(restored), ['q1', 'a1', 'q2', 'a2'])
+
+class ConversationStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'conversations.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def make_store(self):
+        return ConversationStore(self.path, archive_after_days=30)
+
+    def segment_files(self):
+        cold_dir = os.path.join(self.dir, chat_core.COLD_DIR)
+        return sorted(os.listdir(cold_dir)) if os.path.isdir(cold_dir) else []
+
+    def archive(self, conversations):
+        """归档并保存，返回新建的分段文件名"""
+        store = self.make_store()
+        self.assertEqual(store.archive_stale(conversations), sum(c.updated_at == OLD for c in conversations))
+        store.save(conversations)
+        return conversations[0].segment
+
+    def test_archive_then_save(self):
+        recent = make_conversation('b', updated_at="29990101_000000")
+        segment = self.archive([make_conversation('a'), recent])
+
+        self.assertEqual(self.segment_files(), [segment])
+        loaded = {conv.id: conv for conv in self.make_store().load()}
+        self.assertEqual(loaded['a'].segment, segment)
+        self.assertEqual(loaded['a'].messages, [])
+        self.assertFalse(loaded['b'].is_archived)
+        self.assertEqual(loaded['b'].messages, recent.messages)
+
+    def test_restore_in_fresh_store(self):
+        self.archive([make_conversation('a')])
+
+        store = self.make_store()
+        conv, = store.load()
+        self.assertEqual(store.archived_messages(conv), make_conversation('a').messages)
+        self.assertTrue(conv.is_archived)
+        store.restore(conv)
+        self.assertFalse(conv.is_archived)
+        self.assertEqual(conv.messages, make_conversation('a').messages)
+
+        store.save([conv])
+        conv, = self.make_store().load()
+        self.assertEqual(conv.messages, make_conversation('a').messages)
+
+    def test_segment_removed_after_last_conversation_leaves(self):
+        segment = self.archive([make_conversation('a'), make_conversation('b')])
+
+        store = self.make_store()
+        a, b = store.load()
+        store.restore(a)
+        store.save([a, b])
+        # b 仍在分段中，分段保留
+        self.assertEqual(self.segment_files(), [segment])
+        # b 被删除后，分段不再被引用
+        store.save([a])
+        self.assertEqual(self.segment_files(), [])
+
+        a, = self.make_store().load()
+        self.assertEqual(a.messages, make_conversation('a').messages)
+
+    def test_unknown_segments_are_kept(self):
+        segment = self.archive([make_conversation('a')])
+        cold_dir = os.path.join(self.dir, chat_core.COLD_DIR)
+        with open(os.path.join(cold_dir, 'stray.json.gz'), 'wb'):
+            pass
+
+        # 没有读取过索引的实例不认识任何分段
+        self.make_store().save([])
+        self.assertEqual(self.segment_files(), [segment, 'stray.json.gz'])
+
+        # 读取索引之后才由其他实例创建的分段也不会被删除
+        store = self.make_store()
+        store.load()
+        other_segment = self.archive([make_conversation('c')])
+        store.save([])
+        self.assertEqual(self.segment_files(), sorted([other_segment, 'stray.json.gz']))
+
+class PlanModelWavesTest(unittest.TestCase):
+    def test_loaded_first_then_largest(self):
+        sizes = {'a': 4 * GB, 'b': 6 * GB, 'c': 3 * GB}
+        self.assertEqual(plan_model_waves(['a', 'b', 'c'], sizes, 10 * GB, loaded={'c'}),
+                         [['c', 'b'], ['a']])
+
+    def test_unknown_size_runs_alone(self):
+        sizes = {'a': 1 * GB, 'b': 1 * GB}
+        self.assertEqual(plan_model_waves(['a', 'x', 'b'], sizes, 10 * GB), [['x'], ['a', 'b']])
+
+    def test_unknown_budget_runs_one_by_one(self):
+        self.assertEqual(plan_model_waves(['a', 'b'], {'a': 1, 'b': 1}, None), [['a'], ['b']])
+
+class PlanCompareWavesTest(unittest.TestCase):
+    def make_pool(self, name, sizes, loaded=(), memory_gb=None):
+        endpoint = Endpoint('http://127.0.0.1:9')
+        endpoint.models = set(sizes)
+        endpoint.sizes = dict(sizes)
+        endpoint.loaded = set(loaded)
+        return EndpointPool(name, [endpoint], memory_gb * GB if memory_gb else None)
+
+    def test_each_pool_is_planned_from_its_own_endpoints(self):
+        router = EndpointRouter({
+            'default': self.make_pool('default', {'a:latest': 6 * GB, 'b:latest': 6 * GB}, memory_gb=8),
+            'vision': self.make_pool('vision', {'v:latest': 6 * GB, 'w:latest': 1 * GB},
+                                     loaded={'w:latest'}, memory_gb=8),
+        }, {'v': 'vision', 'w': 'vision'})
+        with mock.patch.object(chat_core, 'get_router', return_value=router):
+            waves = plan_compare_waves(['a', 'b', 'v', 'w'])
+        # 两个池同时运行；default 池中 a、b 放不进同一批，vision 池中已加载的 w 排在最前
+        self.assertEqual(waves, [['a', 'w', 'v'], ['b']])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,193 @@
+"""endpoints.py 的测试：用本地的模拟 Ollama 服务器验证负载均衡、排队中的故障转移和错误分类
+
+运行: python -m unittest test_endpoints
+"""
+import json
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from endpoints import Endpoint, EndpointPool, EndpointRouter
+
+WAIT = 5  # 等待事件的最长时间（秒），避免测试失败时卡住
+
+class StubHandler(BaseHTTPRequestHandler):
+    """模拟 Ollama 的 /api/tags、/api/ps 和流式 /api/chat"""
+    def do_GET(self):
+        stub = self.server.stub
+        if self.path == '/api/tags':
+            models = stub.models
+        elif self.path == '/api/ps':
+            models = stub.loaded
+        else:
+            self.send_error(404)
+            return
+        self.send_body(200, {'models': [{'name': model, 'model': model} for model in models]})
+
+    def do_POST(self):
+        stub = self.server.stub
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with stub.lock:
+            stub.requests += 1
+        stub.started.release()
+        if request['model'].startswith('broken'):
+            self.send_body(500, {'error': "model failed to load"})
+            return
+        stub.release.wait(WAIT)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        for content, done in ((stub.name, False), ('', True)):
+            chunk = {'model': request['model'], 'message': {'role': 'assistant', 'content': content}, 'done': done}
+            self.wfile.write((json.dumps(chunk) + '\n').encode('utf-8'))
+
+    def send_body(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class StubServer:
+    """一个模拟服务器，release 被设置之前 chat 请求会一直挂起"""
+    def __init__(self, name, models=('m:latest', 'broken:latest'), loaded=()):
+        self.name = name
+        self.models = list(models)
+        self.loaded = list(loaded)
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.started = threading.Semaphore(0)  # 每收到一个 chat 请求释放一次
+        self.release = threading.Event()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.daemon_threads = True
+        self.server.stub = self
+        self.host = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def wait_started(self):
+        if not self.started.acquire(timeout=WAIT):
+            raise AssertionError(f"{self.name} 没有收到请求")
+
+    def close(self):
+        self.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+class ChatCall:
+    """在后台线程中发起一次 chat，记录结果或异常"""
+    def __init__(self, pool, model='m', messages=None):
+        self.text = ""
+        self.error = None
+        self.thread = threading.Thread(
+            target=self.run, args=(pool, model, messages or [{'role': 'user', 'content': 'hi'}]), daemon=True
+        )
+        self.thread.start()
+
+    def run(self, pool, model, messages):
+        try:
+            for chunk in pool.chat(model, messages):
+                self.text += chunk['message']['content']
+        except Exception as e:
+            self.error = e
+
+    def result(self):
+        self.thread.join(WAIT)
+        if self.thread.is_alive():
+            raise AssertionError("请求没有结束")
+        if self.error is not None:
+            raise self.error
+        return self.text
+
+class EndpointPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.close()
+
+    def make_pool(self, *servers):
+        self.servers.extend(servers)
+        return EndpointPool('test', [Endpoint(server.host, max_concurrency=1) for server in servers])
+
+    def test_prefers_loaded_then_least_loaded(self):
+        a = StubServer('a')
+        b = StubServer('b', loaded=['m:latest'])
+        pool = self.make_pool(a, b)
+        pool.check_health()
+
+        # b 已加载模型，第一个请求发往 b；b 满载后第二个请求发往空闲的 a
+        first = ChatCall(pool)
+        b.wait_started()
+        second = ChatCall(pool)
+        a.wait_started()
+        a.release.set()
+        b.release.set()
+        self.assertEqual(first.result(), 'b')
+        self.assertEqual(second.result(), 'a')
+
+    def test_queued_request_fails_over(self):
+        a = StubServer('a')
+        b = StubServer('b')
+        pool = self.make_pool(a, b)
+
+        # 两台服务器都满载，第三个请求排队
+        busy = [ChatCall(pool), ChatCall(pool)]
+        a.wait_started()
+        b.wait_started()
+        queued = ChatCall(pool)
+
+        # b 完成手上的请求后宕机，排队的请求先被分到 b，连接失败后把 b 标记为不可用
+        b.close()
+        deadline = time.monotonic() + WAIT
+        while pool.endpoints[1].healthy and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertFalse(pool.endpoints[1].healthy)
+
+        # a 空闲后，排队的请求改发到 a
+        a.release.set()
+        self.assertEqual(sorted(call.result() for call in busy), ['a', 'b'])
+        self.assertEqual(queued.result(), 'a')
+        self.assertTrue(pool.endpoints[0].healthy)
+
+    def test_request_errors_do_not_mark_hosts_down(self):
+        a = StubServer('a')
+        b = StubServer('b')
+        a.release.set()
+        b.release.set()
+        pool = self.make_pool(a, b)
+
+        # 格式错误的消息在发送之前就被客户端拒绝
+        with self.assertRaises(Exception) as raised:
+            ChatCall(pool, messages=[{'role': 'user', 'content': object()}]).result()
+        self.assertNotIsInstance(raised.exception, ConnectionError)
+        # 服务器返回的错误（非 404）原样抛出
+        with self.assertRaises(Exception) as raised:
+            ChatCall(pool, model='broken').result()
+        self.assertEqual(getattr(raised.exception, 'status_code', None), 500)
+
+        self.assertTrue(all(endpoint.healthy for endpoint in pool.endpoints))
+        self.assertIn(ChatCall(pool).result(), ('a', 'b'))
+
+class EndpointRouterTest(unittest.TestCase):
+    def test_models_come_from_background_checks(self):
+        server = StubServer('a')
+        self.addCleanup(server.close)
+        router = EndpointRouter({'default': EndpointPool('default', [Endpoint(server.host)])})
+        self.addCleanup(router.stop)
+        router.start()
+        router.wait_checked()
+        self.assertEqual(router.models(), ['broken:latest', 'm:latest'])
+
+        # 之后的调用直接读取已有状态，不再请求服务器
+        server.models = []
+        router.wait_checked()
+        self.assertEqual(router.models(), ['broken:latest', 'm:latest'])
+
+if __name__ == '__main__':
+    unittest.main()
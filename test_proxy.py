@@ -0,0 +1,47 @@
+"""proxy.py 中请求转换的测试
+
+运行: python -m unittest test_proxy
+"""
+import unittest
+
+from proxy import ollama_messages, ollama_params, openai_messages, openai_params
+
+class OpenAIConversionTest(unittest.TestCase):
+    def test_messages_and_params(self):
+        messages = openai_messages([
+            {'role': 'system', 'content': None},
+            {'role': 'user', 'content': [
+                {'type': 'text', 'text': '这是什么'},
+                {'type': 'image_url', 'image_url': {'url': 'data:image/png;base64,QUJD'}},
+            ]},
+        ])
+        self.assertEqual(messages, [
+            {'role': 'system', 'content': ''},
+            {'role': 'user', 'content': '这是什么', 'images': ['QUJD']},
+        ])
+        self.assertEqual(openai_params({'temperature': 0, 'stop': 'x', 'response_format': {'type': 'json_object'}}),
+                         {'options': {'temperature': 0, 'stop': ['x']}, 'format': 'json'})
+        self.assertEqual(openai_params({'response_format': {'type': 'text'}}), {})
+
+    def test_malformed_requests_raise_value_error(self):
+        for messages in ('hi', ['hi'], [{'content': 'hi'}], [{'role': 'user', 'content': 1}],
+                         [{'role': 'user', 'content': ['hi']}],
+                         [{'role': 'user', 'content': [{'type': 'image_url'}]}]):
+            with self.assertRaises(ValueError, msg=messages):
+                openai_messages(messages)
+        for request in ({'response_format': 'text'}, {'response_format': {'type': 'json_schema', 'json_schema': 1}}):
+            with self.assertRaises(ValueError, msg=request):
+                openai_params(request)
+
+class OllamaConversionTest(unittest.TestCase):
+    def test_malformed_requests_raise_value_error(self):
+        for messages in ({'role': 'user'}, [{'role': 'user', 'content': 1}],
+                         [{'role': 'user', 'content': 'hi', 'images': 'QUJD'}]):
+            with self.assertRaises(ValueError, msg=messages):
+                ollama_messages(messages)
+        with self.assertRaises(ValueError):
+            ollama_params({'options': 'fast'})
+        self.assertEqual(ollama_params({'options': {'seed': 1}, 'format': None}), {'options': {'seed': 1}})
+
+if __name__ == '__main__':
+    unittest.main()